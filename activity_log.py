@@ -0,0 +1,100 @@
+import atexit
+import queue
+import threading
+import time as t
+
+FLUSH = object()  # wakes the worker to write what it has straight away
+
+
+class ActivityLog:
+    # Bounded in-process queue of activity events written by one background thread, so page
+    # renders never wait on analytics writes. The worker writes a batch once `batch_size` events
+    # are queued or `interval` seconds have passed, retrying failed writes with exponential backoff.
+    # Every event gets its key from `key` when it is logged, so a retried batch rewrites the same
+    # children rather than adding them again. Events that can't be queued or written are counted in
+    # `dropped`.
+    def __init__(self, writer, key, max_queue=10000, batch_size=200, interval=2.0, max_retries=5, backoff=0.5,
+                 max_backoff=30.0):
+        self.writer = writer  # writer({key: event}) of one batch
+        self.key = key
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.retries = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='activity-log', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def log(self, event):
+        with self.lock:
+            key = self.key()
+        try:
+            self.queue.put_nowait((key, event))
+            return True
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+
+    def flush(self):
+        # ask the worker to write what is queued now, without waiting for it
+        try:
+            self.queue.put_nowait(FLUSH)
+        except queue.Full:
+            pass  # a full queue is written as soon as the worker gets to it
+
+    def close(self, timeout=10):
+        if self.stopping.is_set():
+            return
+        self.stopping.set()
+        self.flush()
+        self.thread.join(timeout)
+
+    def stats(self):
+        with self.lock:
+            return {'queued': self.queue.qsize(), 'written': self.written, 'dropped': self.dropped,
+                    'retries': self.retries}
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._write(batch)
+            if self.stopping.is_set() and self.queue.empty():
+                return
+
+    def _next_batch(self):
+        batch = []
+        deadline = t.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            try:
+                event = self.queue.get(timeout=max(deadline - t.monotonic(), 0))
+            except queue.Empty:
+                break
+            if event is FLUSH:
+                break
+            batch.append(event)
+        return batch
+
+    def _write(self, batch):
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.writer(dict(batch))
+                with self.lock:
+                    self.written += len(batch)
+                return
+            except Exception:  # the worker must outlive any network or database error
+                if attempt == self.max_retries or self.stopping.is_set():
+                    break
+                with self.lock:
+                    self.retries += 1
+                t.sleep(min(self.backoff * 2 ** attempt, self.max_backoff))
+        with self.lock:
+            self.dropped += len(batch)
@@ -0,0 +1,81 @@
+import argparse
+import random
+import requests
+from schema import load_schema
+from survey_store import trend_frame, aggregate_items, query, index_rules, response_path, AGGREGATE_TREE, INDEXES
+from benchmarks.fake_firebase import FakeStore, FakeDatabase
+from benchmarks.cohort import populate
+from benchmarks.run import WORKBOOK, course_start
+
+# Checks of the data layer against a stand-in filled with a synthetic cohort; they raise
+# AssertionError on the first failure. Run from the repository root:
+#   python -m benchmarks.check
+TREND_COLUMNS = ['week', 'group', 'item', 'choice', 'count', 'responses', 'share']
+
+
+def check_trends(store, schema):
+    # surveys nobody has answered yet, or whose group-weeks only have a responses counter, give an
+    # empty frame rather than failing
+    for tree in [None, {}, {'week-1': {'group-1': {'responses': 3}}}]:
+        frame = trend_frame(tree)
+        assert frame.empty and list(frame.columns) == TREND_COLUMNS, tree
+    # every single-choice question's shares add up to one per group-week
+    frame = trend_frame(store.data[AGGREGATE_TREE]['pre'])
+    assert list(frame.columns) == TREND_COLUMNS
+    single = [q.item for q in schema.pre if q.choice_type == 'select_slider' and q.item in aggregate_items(schema.pre)]
+    shares = frame[frame['item'].isin(single)].groupby(['week', 'group', 'item'])['share'].sum()
+    assert not shares.empty and ((shares - 1).abs() < 1e-9).all(), shares[(shares - 1).abs() >= 1e-9]
+    return {'trend_rows': len(frame)}
+
+
+def check_queries(store, schema, samples=20):
+    # the database's filtering gives what filtering the downloaded children would
+    db, rng = FakeDatabase(store), random.Random(0)
+    sources = [('activities', store.data['activities'])]
+    sources += [(response_path(survey_type, week, group), store.data[tree][wk][gk])
+                for survey_type, tree in [('pre', 'pre-survey'), ('post', 'post-survey')]
+                for wk in store.data.get(tree, {}) for gk in store.data[tree][wk]
+                for week, group in [(wk.split('-', 1)[1], gk.split('-', 1)[1])]]
+    for path, children in rng.sample(sources[1:], min(samples, len(sources) - 1)) + sources[:1]:
+        times = sorted(child['timestamp'] for child in children.values())
+        start, end = sorted(rng.sample(times, 2)) if len(times) > 1 else (times[0], times[0])
+        ordered = sorted(children, key=lambda key: (children[key]['timestamp'], key))
+        between = [key for key in ordered if start <= children[key]['timestamp'] <= end]
+        assert list(query(db, path, 'timestamp', start_at=start, end_at=end)) == between, path
+        assert list(query(db, path, 'timestamp', start_at=start)) == \
+            [key for key in ordered if children[key]['timestamp'] >= start], path
+        assert list(query(db, path, 'timestamp', end_at=end, limit=3)) == \
+            [key for key in ordered if children[key]['timestamp'] <= end][:3], path
+        assert list(query(db, path, 'timestamp', equal_to=start)) == \
+            [key for key in ordered if children[key]['timestamp'] == start], path
+    # the same queries are refused once INDEXES doesn't cover them, as Firebase does without an
+    # ".indexOn" rule, and so are queries by children INDEXES leaves out
+    bare = FakeDatabase(FakeStore(data=store.data, indexes={}))
+    refused = [(bare, path, 'timestamp') for path, _ in sources[:2]]
+    refused += [(db, 'activities', 'id'), (db, 'users', 'group'), (db, sources[1][0], 'id')]
+    for database, path, child in refused:
+        try:
+            query(database, path, child, equal_to='x')
+        except requests.exceptions.HTTPError:
+            continue
+        raise AssertionError('unindexed query on %s by %s was answered' % (path, child))
+    # existing indexes are kept, also when given as a single string
+    rules = index_rules({'rules': {'activities': {'.indexOn': 'timestamps'}}})
+    assert rules['rules']['activities']['.indexOn'] == ['timestamps', 'timestamp'], rules
+    return {'paths': min(samples, len(sources) - 1) + 1}
+
+
+CHECKS = [check_trends, check_queries]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check the data layer against the Firebase stand-in.')
+    parser.add_argument('--users', type=int, default=60)
+    parser.add_argument('--weeks', type=int, default=9)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    schema = load_schema(WORKBOOK)
+    store = FakeStore(indexes=INDEXES)
+    populate(store, schema, course_start(args.weeks), users=args.users, weeks=args.weeks, seed=args.seed)
+    for check in CHECKS:
+        print(check.__name__, check(store, schema))
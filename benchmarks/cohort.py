@@ -0,0 +1,102 @@
+import random
+from datetime import datetime, timedelta
+from survey_store import response_path, index_path, index_entry, rebuild_aggregates, rebuild_terms
+from benchmarks.fake_firebase import FakeDatabase
+
+# Synthetic cohorts for the benchmarks: every student answers the real questions of the workbook,
+# with skewed choices and short free-text answers drawn from a course-flavoured vocabulary, so
+# charts, word clouds and the goals table see data shaped like a live term.
+GROUPS = 10
+PASSWORD = 'benchmark'
+
+TOPICS = ['the group project', 'our design case', 'the weekly reading', 'learning theories', 'the prototype',
+          'the logic model', 'orchestration', 'the evaluation plan', 'our presentation', 'multimodal learning',
+          'the literature review', 'user research', 'the discussion board', 'edtech values', 'the seminar task']
+VERBS = ['understand', 'finish', 'discuss', 'improve', 'plan', 'review', 'draft', 'share', 'explain', 'compare']
+WAYS = ['meet with my group twice', 'split the tasks early', 'read the slides before class', 'ask the tutor',
+        'keep notes in our shared document', 'set a deadline for each part', 'give feedback on drafts',
+        'spend an hour every evening', 'watch the recorded lecture', 'check in on the group chat']
+ACTIVITIES = ['login', 'logout', 'see_homepage', 'see_submit_pre_survey_page', 'see_pre_survey_page',
+              'see_submit_post_survey_page', 'see_post_survey_page', 'submit_pre_survey', 'submit_post_survey']
+OBSTACLES = ['finding a time to meet', 'agreeing on a topic', 'people not replying', 'unclear instructions',
+             'too much reading', 'different standards for the work', 'keeping the discussion on task']
+
+
+def sentence(rng, kind):
+    if kind == 'goal':
+        return 'I want to ' + rng.choice(VERBS) + ' ' + rng.choice(TOPICS)
+    if kind == 'plan':
+        return 'I will ' + rng.choice(WAYS) + ' and ' + rng.choice(WAYS)
+    if kind == 'obstacle':
+        return 'It was ' + rng.choice(OBSTACLES) + ' when we worked on ' + rng.choice(TOPICS)
+    return 'Because ' + rng.choice(TOPICS) + ' helps me ' + rng.choice(VERBS) + ' ' + rng.choice(TOPICS)
+
+
+def answer(rng, q, objectives, blank_rate=0.1):
+    if q.choice_type == 'select_slider':
+        # students lean towards the middle and upper choices
+        weights = [1 + i * (len(q.choices) - i) for i in range(len(q.choices))]
+        return rng.choices(q.choices, weights=weights)[0]
+    if q.choice_type == 'multiselect':
+        return rng.sample(q.choices, rng.randint(1, min(3, len(q.choices))))
+    if q.choice_type == 'selectbox':
+        return rng.choice(objectives) if objectives else None
+    if rng.random() < blank_rate:
+        return ''
+    kind = {'Goal(s)': 'goal', 'Plan(s)': 'plan', 'Plan': 'plan', 'Perceived Challenges': 'obstacle'}.get(q.category)
+    return sentence(rng, kind)
+
+
+def cohort(schema, start_day, users=200, weeks=9, response_rate=0.85, activities=20, seed=0):
+    # the database tree and auth accounts of `users` students in GROUPS groups after `weeks` weeks;
+    # each student answers each weekly survey with probability `response_rate` and leaves about
+    # `activities` activity log entries per week, none of them later than now
+    rng = random.Random(seed)
+    now = datetime.now()
+    data, accounts = {'users': {}, 'activities': {}}, {}
+    updates = {}
+    for n in range(users):
+        uid = 'uid%05d' % n
+        email = 'student%d@example.ac.uk' % n
+        group = str(n % GROUPS + 1)
+        accounts[email] = {'password': PASSWORD, 'localId': uid}
+        data['users'][uid] = {'id': uid, 'name': 'Student %d' % n, 'email': email, 'group': group}
+        for week in range(1, weeks + 1):
+            monday = start_day + timedelta(weeks=week - 1)
+            for survey_type, questions, day in [('pre', schema.pre, 0), ('post', schema.post, 3)]:
+                if rng.random() > response_rate:
+                    continue
+                time = monday + timedelta(days=day + rng.random() * 2)
+                if time > now:
+                    continue  # later this week
+                response = {q.item: answer(rng, q, schema.objectives.get(week, ())) for q in questions}
+                record = {'id': uid, 'timestamp': int(time.timestamp() * 1000), 'response': response}
+                updates[response_path(survey_type, week, group, uid)] = record
+                updates[index_path(uid, survey_type, week)] = index_entry(record)
+            for i in range(activities):
+                time = monday + timedelta(seconds=rng.random() * 7 * 24 * 3600)
+                if time > now:
+                    continue
+                data['activities']['%s-%02d-%s-%03d' % (int(time.timestamp()), week, uid, i)] = \
+                    {'timestamp': int(time.timestamp() * 1000), 'activity': rng.choice(ACTIVITIES), 'id': uid}
+    for path, value in updates.items():
+        node = data
+        parts = path.split('/')
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    return data, accounts
+
+
+def populate(store, schema, start_day, **kwargs):
+    # fill a FakeStore with a cohort; aggregates and word counts come from the same code the CLI rebuilds them with
+    data, accounts = cohort(schema, start_day, **kwargs)
+    latency, store.latency = store.latency, 0.0
+    store.data = data
+    rebuild_aggregates(FakeDatabase(store), {'pre': schema.pre, 'post': schema.post})
+    rebuild_terms(FakeDatabase(store), {'pre': schema.pre, 'post': schema.post})
+    store.latency = latency
+    store.requests.clear()
+    store.bytes = 0
+    return accounts
+
@@ -0,0 +1,370 @@
+import copy
+import itertools
+import json
+import queue
+import random
+import string
+import sys
+import threading
+import time as t
+import types
+from collections import Counter
+import requests
+
+# In-process stand-in for the parts of Firebase that main.py uses: pyrebase's auth/database surface,
+# REST reads through fetch.Fetcher (with orderBy/startAt/endAt/equalTo/limitTo* query semantics) and
+# the streaming events read by replica.Replica. Every request can be delayed by `latency` seconds
+# to stand in for the network, and requests and downloaded bytes are counted per kind. Given
+# `indexes` (see survey_store.INDEXES), queries ordered by an unindexed child fail like in Firebase.
+
+PUSH_CHARS = '-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz'
+
+
+class FakeStore:
+    def __init__(self, data=None, latency=0.0, keep_alive=30.0, indexes=None):
+        self.data = data if data is not None else {}
+        self.latency = latency
+        self.indexes = indexes
+        self.keep_alive = keep_alive
+        self.lock = threading.RLock()
+        self.listeners = []  # (tree, queue of stream events)
+        self.requests = Counter()
+        self.bytes = 0
+        self.push_ids = itertools.count()
+
+    def read(self, path, query=None):
+        self._request('read')
+        order = (query or {}).get('orderBy', '$key')
+        if self.indexes is not None and order not in ('$key', '$value') and not indexed(self.indexes, path, order):
+            raise requests.exceptions.HTTPError('400 Client Error: Index not defined, add ".indexOn": "%s", for path '
+                                                '"/%s", to the rules' % (order, join(path)))
+        with self.lock:
+            value = apply_query(copy.deepcopy(self._node(path)), query)
+        self.bytes += len(json.dumps(value))
+        return value
+
+    def write(self, path, value):
+        self._request('write')
+        with self.lock:
+            self._set(path, json.loads(json.dumps(value)))
+            self._notify(path, 'put', value)
+        return value
+
+    def update(self, path, values):
+        # multi-path update; {'.sv': {'increment': n}} values are applied like server-side increments
+        self._request('update')
+        with self.lock:
+            changes = {}
+            for key, value in values.items():
+                full = join(path, key)
+                if isinstance(value, dict) and '.sv' in value:
+                    value = (self._node(full) or 0) + value['.sv']['increment']
+                self._set(full, json.loads(json.dumps(value)))
+                changes[full] = value
+            for full, value in changes.items():
+                self._notify(full, 'put', value)
+        return values
+
+    def push(self, path, value):
+        key = self.push_key()
+        self.write(join(path, key), value)
+        return {'name': key}
+
+    def push_key(self):
+        # chronologically ordered keys like Firebase push ids
+        now, n = int(t.time() * 1000), next(self.push_ids)
+        stamp = ''.join(PUSH_CHARS[(now >> (6 * i)) % 64] for i in reversed(range(8)))
+        return stamp + ''.join(PUSH_CHARS[(n >> (6 * i)) % 64] for i in reversed(range(4))) + \
+            ''.join(random.choice(string.ascii_letters) for _ in range(8))
+
+    def events(self, tree):
+        # stream source for replica.Replica: a put of the whole tree, then every change below it
+        changes = queue.Queue()
+        with self.lock:
+            self.listeners.append((tree, changes))
+            initial = copy.deepcopy(self._node(tree))
+        try:
+            yield {'event': 'put', 'path': '/', 'data': initial}
+            while True:
+                try:
+                    event = changes.get(timeout=self.keep_alive)
+                except queue.Empty:
+                    event = {'event': 'keep-alive'}
+                if event is None:
+                    return  # disconnect()
+                yield event
+        finally:
+            with self.lock:
+                self.listeners = [(name, q) for name, q in self.listeners if q is not changes]
+
+    def disconnect(self, tree=None):
+        # drop the open streams, as a lost connection would
+        with self.lock:
+            for name, changes in self.listeners:
+                if tree is None or name == tree:
+                    changes.put(None)
+
+    def _request(self, kind):
+        if self.latency:
+            t.sleep(self.latency)
+        with self.lock:
+            self.requests[kind] += 1
+
+    def _node(self, path):
+        node = self.data
+        for part in split(path):
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def _set(self, path, value):
+        parts = split(path)
+        if not parts:
+            self.data = value if isinstance(value, dict) else {}
+            return
+        node, trail = self.data, []
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            trail.append((node, part))
+            node = node[part]
+        if value is None or value == {}:
+            node.pop(parts[-1], None)
+            for parent, part in reversed(trail):
+                if parent[part]:
+                    break
+                del parent[part]
+        else:
+            node[parts[-1]] = value
+
+    def _notify(self, path, kind, value):
+        parts = split(path)
+        for tree, changes in self.listeners:
+            if parts[:1] == [tree]:
+                changes.put({'event': kind, 'path': '/' + '/'.join(parts[1:]), 'data': copy.deepcopy(value)})
+            elif not parts:
+                changes.put({'event': 'put', 'path': '/', 'data': copy.deepcopy((value or {}).get(tree))})
+
+
+def split(path):
+    return [part for part in str(path).split('/') if part]
+
+
+def join(*paths):
+    return '/'.join(part for path in paths for part in split(path))
+
+
+def indexed(indexes, path, child):
+    parts = split(path)
+    return any(child in children and len(split(pattern)) == len(parts) and
+               all(p.startswith('$') or p == part for p, part in zip(split(pattern), parts))
+               for pattern, children in indexes.items())
+
+
+def apply_query(value, query):
+    # Realtime Database query semantics: order by key, value or a child, filter with
+    # startAt/endAt/equalTo, then keep the first or last N
+    if not query or not isinstance(value, dict):
+        return value
+    order = query.get('orderBy', '$key')
+
+    def ordered(item):
+        key, child = item
+        if order == '$key':
+            return key
+        if order == '$value':
+            return child
+        for part in split(order):
+            child = child.get(part) if isinstance(child, dict) else None
+        return child
+    items = sorted(value.items(), key=lambda item: (rank(ordered(item)), item[0]))
+    if 'equalTo' in query:
+        items = [i for i in items if rank(ordered(i)) == rank(query['equalTo'])]
+    if 'startAt' in query:
+        items = [i for i in items if rank(ordered(i)) >= rank(query['startAt'])]
+    if 'endAt' in query:
+        items = [i for i in items if rank(ordered(i)) <= rank(query['endAt'])]
+    if 'limitToFirst' in query:
+        items = items[:query['limitToFirst']]
+    if 'limitToLast' in query:
+        items = items[-query['limitToLast']:]
+    return dict(items)
+
+
+def rank(value):
+    # Firebase sort order: null < false < true < numbers < strings < objects
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, int(value))
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    return (4, 0)
+
+
+class FakeResponse:
+    def __init__(self, value, key):
+        self.value = value
+        self.query_key = key
+
+    def val(self):
+        return self.value
+
+    def key(self):
+        return self.query_key
+
+    def each(self):
+        if isinstance(self.value, dict):
+            return [FakeResponse(value, key) for key, value in self.value.items()]
+
+
+class FakeDatabase:
+    # pyrebase.Database: child()/query builders accumulate a path and query until a request uses them
+    def __init__(self, store):
+        self.store = store
+        self.path = ''
+        self.build_query = {}
+
+    def child(self, *args):
+        self.path = join(self.path, *[str(arg) for arg in args])
+        return self
+
+    def order_by_key(self):
+        self.build_query['orderBy'] = '$key'
+        return self
+
+    def order_by_value(self):
+        self.build_query['orderBy'] = '$value'
+        return self
+
+    def order_by_child(self, order):
+        self.build_query['orderBy'] = order
+        return self
+
+    def start_at(self, start):
+        self.build_query['startAt'] = start
+        return self
+
+    def end_at(self, end):
+        self.build_query['endAt'] = end
+        return self
+
+    def equal_to(self, equal):
+        self.build_query['equalTo'] = equal
+        return self
+
+    def limit_to_first(self, limit):
+        self.build_query['limitToFirst'] = limit
+        return self
+
+    def limit_to_last(self, limit):
+        self.build_query['limitToLast'] = limit
+        return self
+
+    def get(self, token=None, json_kwargs={}):
+        path, query = self._take()
+        return FakeResponse(self.store.read(path, query), path.split('/')[-1])
+
+    def set(self, data, token=None, json_kwargs={}):
+        path, _ = self._take()
+        return self.store.write(path, data)
+
+    def update(self, data, token=None, json_kwargs={}):
+        path, _ = self._take()
+        return self.store.update(path, data)
+
+    def push(self, data, token=None, json_kwargs={}):
+        path, _ = self._take()
+        return self.store.push(path, data)
+
+    def remove(self, token=None):
+        path, _ = self._take()
+        self.store.write(path, None)
+
+    def generate_key(self):
+        return self.store.push_key()
+
+    def _take(self):
+        path, query = self.path, self.build_query
+        self.path, self.build_query = '', {}
+        return path, query
+
+
+class FakeAuth:
+    # email/password accounts with the same error payloads pyrebase surfaces from the Identity Toolkit
+    def __init__(self, accounts):
+        self.accounts = accounts  # email -> {'password', 'localId'}
+        self.current_user = None
+        self.lock = threading.Lock()
+
+    def sign_in_with_email_and_password(self, email, password):
+        account = self.accounts.get(email)
+        if account is None:
+            raise auth_error('EMAIL_NOT_FOUND')
+        if account['password'] != password:
+            raise auth_error('INVALID_PASSWORD')
+        return {'localId': account['localId'], 'email': email, 'idToken': 'token-' + account['localId']}
+
+    def create_user_with_email_and_password(self, email, password):
+        with self.lock:
+            if email in self.accounts:
+                raise auth_error('EMAIL_EXISTS')
+            uid = 'uid' + ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(25))
+            self.accounts[email] = {'password': password, 'localId': uid}
+        return {'localId': uid, 'email': email, 'idToken': 'token-' + uid}
+
+    def send_password_reset_email(self, email):
+        if '@' not in (email or ''):
+            raise auth_error('INVALID_EMAIL')
+        return {'email': email}
+
+    def delete_user_account(self, id_token):
+        with self.lock:
+            for email, account in list(self.accounts.items()):
+                if 'token-' + account['localId'] == id_token:
+                    del self.accounts[email]
+
+
+def auth_error(message):
+    return requests.exceptions.HTTPError('400 Client Error', json.dumps({'error': {'message': message}}))
+
+
+class FakeFirebase:
+    def __init__(self, config, store, accounts):
+        self.config = config
+        self.store = store
+        self.accounts = accounts
+        self.requests = None
+
+    def auth(self):
+        return FakeAuth(self.accounts)
+
+    def database(self):
+        return FakeDatabase(self.store)
+
+    def storage(self):
+        return None
+
+
+def install(store, accounts):
+    # route main.py's pyrebase calls, REST reads and streams to `store`; call before importing main
+    import fetch
+    import replica
+
+    class FakeFetcher(fetch.Fetcher):
+        def download(self, path, timeout=None):
+            value = self.store.read(path)
+            return value, len(json.dumps(value))
+
+        def patch(self, path, values, timeout=None):
+            self.store.update(path, values)
+    FakeFetcher.store = store
+
+    module = types.ModuleType('pyrebase')
+    module.initialize_app = lambda config: FakeFirebase(config, store, accounts)
+    sys.modules['pyrebase'] = module
+    fetch.Fetcher = FakeFetcher
+    replica.firebase_events = lambda database_url, **kwargs: store.events
@@ -0,0 +1,349 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time as t
+import traceback
+import tracemalloc
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+import streamlit as st
+import metrics
+from schema import load_schema
+from survey_store import INDEXES
+from benchmarks.fake_firebase import FakeStore, install
+from benchmarks.cohort import populate, answer, PASSWORD
+
+# Benchmarks for the pages of main.py, run against an in-process Firebase stand-in filled with a
+# synthetic cohort. Run from the repository root:
+#   python -m benchmarks.run                              timed scenarios, cold and warm
+#   python -m benchmarks.run --sessions 20 --duration 30  concurrent students clicking through pages
+#   python -m benchmarks.run --baseline benchmarks/results/<earlier>.json
+# Results are written as JSON to benchmarks/results/.
+WORKBOOK = 'input/survey_questions.xlsx'
+RESULTS = 'benchmarks/results'
+SECRETS = {'apiKey': 'benchmark', 'authDomain': 'benchmark.firebaseapp.com', 'projectId': 'benchmark',
+           'databaseURL': 'https://benchmark.firebaseio.com', 'storageBucket': 'benchmark.appspot.com',
+           'messagingSenderId': '0', 'appId': 'benchmark', 'measurementId': 'benchmark'}
+PAGES = ['😃 My weekly goals/plans', '📮 Pre-survey Submission', '📊 Pre-survey Results',
+         '📮 Post-survey Submission', '📊 Post-survey Results']
+
+
+class SessionState:
+    # stands in for st.session_state outside a Streamlit server: one dict per thread, so every
+    # simulated student keeps their own session
+    def __init__(self):
+        object.__setattr__(self, '_local', threading.local())
+
+    def _state(self):
+        if not hasattr(self._local, 'state'):
+            self._local.state = {}
+        return self._local.state
+
+    def __contains__(self, key):
+        return key in self._state()
+
+    def __getitem__(self, key):
+        return self._state()[key]
+
+    def __setitem__(self, key, value):
+        self._state()[key] = value
+
+    def __getattr__(self, key):
+        try:
+            return self._state()[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        self._state()[key] = value
+
+    def get(self, key, default=None):
+        return self._state().get(key, default)
+
+    def pop(self, key, default=None):
+        return self._state().pop(key, default)
+
+    def use(self, state):
+        # switch this thread to another student's session
+        self._local.state = state
+
+
+def course_start(weeks):
+    # a Monday that makes this the cohort's last week
+    today = datetime.combine(datetime.today().date(), datetime.min.time())
+    return today - timedelta(days=today.weekday(), weeks=weeks - 1)
+
+
+def secrets(args, start_day):
+    return dict(SECRETS, start_day=start_day.date().isoformat(), replica_mode=args.replica)
+
+
+def setup(args, import_app=True):
+    # a populated stand-in with main.py's Firebase pointed at it; main is imported after the fakes,
+    # with a session state that works outside a Streamlit server
+    schema = load_schema(WORKBOOK)
+    start_day = course_start(args.weeks)
+    store = FakeStore(latency=args.latency / 1000, indexes=INDEXES)
+    accounts = populate(store, schema, start_day, users=args.users, weeks=args.weeks, seed=args.seed)
+    install(store, accounts)
+    st.secrets._secrets = secrets(args, start_day)
+    if not import_app:
+        return None, store, accounts
+    st.session_state = SessionState()
+    import main
+    if args.replica:
+        while not main.replica().is_fresh(*main.replica().data):
+            t.sleep(0.05)
+    return main, store, accounts
+
+
+def login(app, email, sessions):
+    # the student's session, signing in on their first visit
+    if email not in sessions:
+        sessions[email] = {'user': app.auth.sign_in_with_email_and_password(email, PASSWORD), 'login_state': True}
+    st.session_state.use(sessions[email])
+    return sessions[email]['user']
+
+
+def reset(app):
+    # back to a freshly started process: nothing downloaded, rendered or kept in the session
+    app.tree_cache().clear()
+    app.wordcloud_cache().clear()
+    app.figure_cache().clear()
+    st.session_state.pop('profile')
+
+
+def submit(app, user, survey_type, rng):
+    week, group = app.week_no(), app.user_group(user)
+    questions = app.pre_questions if survey_type == 'pre' else app.post_questions
+    response = {q.item: answer(rng, q, app.learning_obj.get(week, ())) for q in questions}
+    previous = app.fetcher().get(app.response_path(survey_type, week, group, user['localId']))
+    if not app.submit_survey(user, survey_type, week, group, response, previous):
+        raise RuntimeError('submission failed')
+
+
+def visit(app, user, page, rng):
+    # what main() does for a page once the student is logged in, without the sidebar widgets
+    if page == PAGES[0]:
+        app.log('see_homepage', user)
+        app.pull_goals(user)
+    elif page in (PAGES[1], PAGES[3]):
+        survey_type = 'pre' if page == PAGES[1] else 'post'
+        app.log('see_submit_' + survey_type + '_survey_page', user)
+        week, group = app.week_no(), app.user_group(user)
+        app.fetcher().get(app.response_path(survey_type, week, group, user['localId']))
+        app.pre_survey() if survey_type == 'pre' else app.post_survey()
+    else:
+        survey_type = 'pre' if page == PAGES[2] else 'post'
+        app.log('see_' + survey_type + '_survey_page', user)
+        app.pull_results(user, survey_type)
+
+
+SCENARIOS = {
+    'pull_results_pre': lambda app, user, rng: app.pull_results(user, 'pre'),
+    'pull_results_post': lambda app, user, rng: app.pull_results(user, 'post'),
+    'pull_goals': lambda app, user, rng: app.pull_goals(user),
+    'pre_survey': lambda app, user, rng: app.pre_survey(),
+    'post_survey': lambda app, user, rng: app.post_survey(),
+    'log': lambda app, user, rng: app.log('benchmark', user),
+    'submit_pre_survey': lambda app, user, rng: submit(app, user, 'pre', rng),
+}
+COLD = ['pull_results_pre', 'pull_results_post', 'pull_goals']  # scenarios whose first visit downloads and renders
+
+
+def summary(seconds):
+    ms = np.array(seconds) * 1000
+    return {'n': len(ms), 'mean_ms': float(ms.mean()), 'p50_ms': float(np.percentile(ms, 50)),
+            'p90_ms': float(np.percentile(ms, 90)), 'p99_ms': float(np.percentile(ms, 99)), 'max_ms': float(ms.max())}
+
+
+def run_scenario(app, store, users, name, cold, iterations, rng):
+    # timed iterations over students of every group, then one more under tracemalloc for the peak
+    scenario = SCENARIOS[name]
+    sessions = {}
+    if not cold:
+        for email in users[:iterations]:  # every student's session and group data loaded once
+            user = login(app, email, sessions)
+            scenario(app, user, rng)
+    requests, downloaded = store.requests.copy(), store.bytes
+    times, spans = [], {}
+    for i in range(iterations):
+        user = login(app, users[i % len(users)], sessions)
+        if cold:
+            reset(app)
+        rerun = metrics.Rerun()
+        start = t.perf_counter()
+        with metrics.active(rerun):
+            scenario(app, user, rng)
+        times.append(t.perf_counter() - start)
+        for span in rerun.to_dict()['spans']:
+            spans[span['name']] = spans.get(span['name'], 0) + span['ms']
+    result = summary(times)
+    result['span_ms_per_run'] = {name: ms / iterations for name, ms in sorted(spans.items())}
+    # activity log batches are written in the background and show up as updates
+    result['requests_per_run'] = {kind: n / iterations for kind, n in (store.requests - requests).items()}
+    result['kb_per_run'] = (store.bytes - downloaded) / iterations / 1024
+
+    user = login(app, users[0], sessions)
+    if cold:
+        reset(app)
+    tracemalloc.start()
+    scenario(app, user, rng)
+    result['peak_kb'] = tracemalloc.get_traced_memory()[1] / 1024
+    tracemalloc.stop()
+    return result
+
+
+def run_scenarios(app, store, accounts, args):
+    rng = random.Random(args.seed)
+    users = sorted(accounts)
+    results = {}
+    for name in args.scenario or SCENARIOS:
+        variants = [('cold', True, args.cold_iterations), ('warm', False, args.iterations)] if name in COLD else \
+            [('warm', False, args.iterations)]
+        for variant, cold, iterations in variants:
+            key = name + '/' + variant
+            results[key] = run_scenario(app, store, users, name, cold, iterations, rng)
+            print('%-28s p50 %8.1fms  p90 %8.1fms  p99 %8.1fms  peak %8.0fkB  %5.1f reads' % (
+                key, results[key]['p50_ms'], results[key]['p90_ms'], results[key]['p99_ms'],
+                results[key]['peak_kb'], results[key]['requests_per_run'].get('read', 0)))
+    return results
+
+
+def run_load(app, store, accounts, args):
+    # `sessions` students at once, each logging in and clicking through random pages for `duration`
+    # seconds. With Streamlit's app testing API every page view is a full rerun of main.py; AppTest
+    # swaps process-wide state (the runtime and st.secrets) while it runs, so reruns take turns and
+    # the sessions overlap only in the background work they share, like the fetch and word cloud
+    # pools and the activity log. Without it the page functions run on truly concurrent threads.
+    AppTest = app_test()
+    users = sorted(accounts)
+    times = {page: [] for page in PAGES}
+    errors = []
+    deadline = t.time() + args.duration
+    lock, rerun = threading.Lock(), threading.Lock()
+
+    def student(n):
+        rng = random.Random(args.seed + n)
+        try:
+            if AppTest is not None:
+                session = AppTest.from_file('main.py', default_timeout=120)
+                session.secrets.update(st.secrets._secrets)
+                with rerun:
+                    session.run()
+                    session.text_input[0].input(users[n % len(users)])
+                    session.text_input[1].input(PASSWORD)
+                    session.button[0].click().run()
+            else:
+                user = login(app, users[n % len(users)], {})
+            while t.time() < deadline:
+                page = rng.choice(PAGES)
+                if AppTest is not None:
+                    with rerun:
+                        start = t.perf_counter()
+                        [menu for menu in session.sidebar.selectbox if menu.label == 'Menu'][-1].select(page).run()
+                        elapsed = t.perf_counter() - start
+                    if session.exception:
+                        raise RuntimeError(session.exception[0].message)
+                else:
+                    start = t.perf_counter()
+                    visit(app, user, page, rng)
+                    elapsed = t.perf_counter() - start
+                with lock:
+                    times[page].append(elapsed)
+        except Exception:
+            with lock:
+                errors.append(traceback.format_exc())
+
+    threads = [threading.Thread(target=student, args=(n,), daemon=True) for n in range(args.sessions)]
+    start = t.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = t.perf_counter() - start
+    views = sum(len(v) for v in times.values())
+    result = {'mode': 'apptest' if AppTest is not None else 'threads', 'sessions': args.sessions,
+              'seconds': elapsed, 'page_views': views, 'page_views_per_s': views / elapsed,
+              'errors': errors, 'pages': {page: summary(v) for page, v in times.items() if v}}
+    result['all'] = summary([s for v in times.values() for s in v]) if views else None
+    print('%s: %d sessions, %d page views, %.1f/s, %d errors' % (result['mode'], args.sessions, views,
+                                                                 result['page_views_per_s'], len(errors)))
+    for page, stats in result['pages'].items():
+        print('  %-28s p50 %8.1fms  p90 %8.1fms  p99 %8.1fms' % (page, stats['p50_ms'], stats['p90_ms'],
+                                                                stats['p99_ms']))
+    return result
+
+
+def app_test():
+    # Streamlit's headless app testing API (1.28+); older versions load-test the page functions on threads
+    try:
+        from streamlit.testing.v1 import AppTest
+    except ImportError:
+        return None
+    return AppTest
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {'time': datetime.now().isoformat(timespec='seconds'), 'commit': commit, 'python': platform.python_version(),
+            'platform': platform.platform(), 'streamlit': st.__version__, 'pandas': pd.__version__,
+            'args': vars(args)}
+
+
+def compare(results, baseline):
+    # p50/p90 of every scenario and page against an earlier run; ratios above 1 are slower
+    pairs = [(results.get('scenarios', {}), baseline.get('scenarios', {})),
+             (results.get('load', {}).get('pages', {}), baseline.get('load', {}).get('pages', {}))]
+    for current, earlier in pairs:
+        for key, stats in current.items():
+            before = earlier.get(key)
+            if before:
+                print('%-28s p50 x%.2f  p90 x%.2f' % (key, stats['p50_ms'] / before['p50_ms'],
+                                                      stats['p90_ms'] / before['p90_ms']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the pages against a synthetic cohort.')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--weeks', type=int, default=9)
+    parser.add_argument('--latency', type=float, default=0.0, help='ms added to every database request')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--cold-iterations', type=int, default=5)
+    parser.add_argument('--scenario', choices=list(SCENARIOS), action='append')
+    parser.add_argument('--sessions', type=int, default=0, help='concurrent students for the load run')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds of the load run')
+    parser.add_argument('--replica', action='store_true', help='serve reads from the streaming replica')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', help='an earlier results file to compare with')
+    parser.add_argument('--output', help='results file (default: benchmarks/results/<time>.json)')
+    args = parser.parse_args()
+    logging.getLogger('streamlit').setLevel(logging.ERROR)  # no ScriptRunContext warnings outside a server
+
+    app, store, accounts = setup(args, import_app=not (args.sessions and app_test()))
+    results = {'meta': metadata(args)}
+    if args.sessions:
+        results['load'] = run_load(app, store, accounts, args)
+    else:
+        results['scenarios'] = run_scenarios(app, store, accounts, args)
+    results['requests'] = dict(store.requests)
+
+    output = args.output or os.path.join(RESULTS, datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, default=str)
+    print('results written to ' + output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    sys.exit(1 if results.get('load', {}).get('errors') else 0)
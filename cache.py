@@ -0,0 +1,88 @@
+import threading
+import time as t
+from collections import OrderedDict
+
+
+class TreeCache:
+    # Process-wide snapshots of decoded Firebase trees, shared by every session.
+    # Entries expire after `ttl` seconds, the least recently used entry is dropped
+    # once there are more than `max_entries`, and a write invalidates every overlapping path.
+    # A path holds one snapshot: reading it at another `version` (e.g. of the replica) replaces it.
+    def __init__(self, ttl=60, max_entries=16):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # path -> (loaded_at, version, value)
+        self.generations = {}  # tree -> number of invalidations so far
+        self.loading = {}  # path -> lock held while the path is downloaded
+        self.lock = threading.Lock()
+
+    def get(self, path, loader, version=None):
+        value, hit = self._lookup(path, version)
+        if hit:
+            return value
+        # only one session downloads a given path; the others wait and reuse its result
+        loading = self._loading_lock(path)
+        with loading:
+            try:
+                value, hit = self._lookup(path, version)
+                if hit:
+                    return value
+                generation = self._generation(path)
+                loaded_at = t.time()
+                value = loader()
+                with self.lock:
+                    # a write landed while we were downloading, so this snapshot is already stale
+                    if generation == self.generations.get(tree_of(path), 0):
+                        self.entries[path] = (loaded_at, version, value)
+                        self.entries.move_to_end(path)
+                        while len(self.entries) > self.max_entries:
+                            self.entries.popitem(last=False)
+                return value
+            finally:
+                # sessions already waiting keep the lock they hold; later ones find the snapshot
+                with self.lock:
+                    if self.loading.get(path) is loading:
+                        del self.loading[path]
+
+    def invalidate(self, path):
+        # drop every snapshot that contains the written path or lies below it
+        with self.lock:
+            tree = tree_of(path)
+            self.generations[tree] = self.generations.get(tree, 0) + 1
+            for cached in [p for p in self.entries if overlaps(p, path)]:
+                del self.entries[cached]
+
+    def clear(self):
+        with self.lock:
+            for tree in {tree_of(p) for p in self.entries}:
+                self.generations[tree] = self.generations.get(tree, 0) + 1
+            self.entries.clear()
+
+    def _lookup(self, path, version=None):
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None:
+                return None, False
+            if t.time() - entry[0] >= self.ttl or entry[1] != version:
+                del self.entries[path]
+                return None, False
+            self.entries.move_to_end(path)
+            return entry[2], True
+
+    def _generation(self, path):
+        with self.lock:
+            return self.generations.get(tree_of(path), 0)
+
+    def _loading_lock(self, path):
+        with self.lock:
+            return self.loading.setdefault(path, threading.Lock())
+
+
+def tree_of(path):
+    return path.strip('/').split('/')[0]
+
+
+def overlaps(a, b):
+    a, b = a.strip('/') + '/', b.strip('/') + '/'
+    return a.startswith(b) or b.startswith(a)
+
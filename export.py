@@ -0,0 +1,210 @@
+import argparse
+import json
+import os
+import time as t
+import uuid
+from datetime import datetime
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from schema import load_schema
+from survey_store import survey_tree, response_path, partition_records, batch_update, connect, as_dict, query, \
+    course_start, week_of, weeks_of, TIMEZONE
+
+# Exports the surveys, users and activity log to Parquet for analysis outside the app, partitioned
+# Hive-style by week (<out>/<dataset>/week=<N>/part-<run>.parquet) with users as one snapshot file.
+# Each run only downloads records newer than the last exported timestamp, using timestamp range
+# queries, which need the indexes of `python survey_store.py index-rules` in the database rules.
+# Files are only ever added, so a response that was submitted again shows up in a later part with
+# a newer timestamp; the latest row per uid and week is the current answer. A run only takes records
+# older than SETTLE_MS, so activities still waiting in an app's log queue are picked up next time.
+STATE_FILE = '_state.json'  # dataset -> last exported timestamp, and the runs so far
+SURVEY_COLUMNS = [('uid', pa.string()), ('week', pa.int16()), ('group', pa.string()), ('timestamp', pa.int64()),
+                  ('date', pa.timestamp('ms', tz=TIMEZONE))]
+ACTIVITY_COLUMNS = [('key', pa.string()), ('uid', pa.string()), ('activity', pa.string()), ('week', pa.int16()),
+                    ('timestamp', pa.int64()), ('date', pa.timestamp('ms', tz=TIMEZONE))]
+USER_COLUMNS = [('uid', pa.string()), ('name', pa.string()), ('email', pa.string()), ('group', pa.string())]
+PAGE_SIZE = 5000  # activities per range query
+DAY_MS = 24 * 3600 * 1000
+SETTLE_MS = 10 * 60 * 1000
+
+
+def question_field(q):
+    # one column per question, typed by how it is answered, with the question text kept as field metadata
+    kind = pa.list_(pa.string()) if q.choice_type == 'multiselect' else pa.string()
+    metadata = {'question': str(q.question), 'category': str(q.category), 'short': str(q.short),
+                'choice_type': q.choice_type, 'chart': q.chart, 'choices': json.dumps(list(q.choices))}
+    return pa.field(q.item, kind, metadata=metadata)
+
+
+def survey_schema(questions):
+    return pa.schema([pa.field(name, kind) for name, kind in SURVEY_COLUMNS] + [question_field(q) for q in questions])
+
+
+def answer_value(q, value):
+    if q.choice_type == 'multiselect':
+        return [str(v) for v in value] if isinstance(value, list) else []  # unanswered is stored as ""
+    return None if value is None else str(value)
+
+
+def survey_table(records, questions):
+    # (week, group, uid, record) rows as one typed table
+    columns = {'uid': [uid for _, _, uid, _ in records], 'week': [week for week, _, _, _ in records],
+               'group': [group for _, group, _, _ in records],
+               'timestamp': [record.get('timestamp') for _, _, _, record in records]}
+    columns['date'] = columns['timestamp']
+    for q in questions:
+        columns[q.item] = [answer_value(q, (record.get('response') or {}).get(q.item)) for _, _, _, record in records]
+    return pa.table(columns, schema=survey_schema(questions))
+
+
+def activity_table(activities, start_day):
+    keys = list(activities)
+    times = [activities[key].get('timestamp') for key in keys]
+    return pa.table({'key': keys, 'uid': [activities[key].get('id') for key in keys],
+                     'activity': [activities[key].get('activity') for key in keys],
+                     'week': weeks_of(times, start_day), 'timestamp': times, 'date': times},
+                    schema=pa.schema(ACTIVITY_COLUMNS))
+
+
+def users_table(users):
+    rows = [(uid, p.get('name'), p.get('email'), None if p.get('group') is None else str(p.get('group')))
+            for uid, p in users.items() if isinstance(p, dict)]
+    return pa.table({name: [row[i] for row in rows] for i, (name, _) in enumerate(USER_COLUMNS)},
+                    schema=pa.schema(USER_COLUMNS))
+
+
+def write_partitions(table, directory, run):
+    # one file per week under week=<N>, which carries the week instead of a column; returns the
+    # number of files written
+    weeks = sorted(set(table.column('week').to_pylist()) - {None})
+    for week in weeks:
+        part = table.filter(pc.equal(table.column('week'), week)).drop(['week'])
+        path = os.path.join(directory, 'week=%d' % week)
+        os.makedirs(path, exist_ok=True)
+        target = os.path.join(path, 'part-%s.parquet' % run)
+        if os.path.exists(target):
+            raise FileExistsError(target)
+        pq.write_table(part, target + '.tmp')
+        os.replace(target + '.tmp', target)
+    return len(weeks)
+
+
+def changed_responses(db, survey_type, since, until, groups, start_day):
+    # responses with a timestamp in (since, until]: the whole tree on the first run, afterwards one
+    # range query per group of each week since the watermark's week, as a response is filed under
+    # the week it was submitted in
+    if since is None:
+        return [r for r in partition_records(db.child(survey_tree(survey_type)).get().val())
+                if (r[3].get('timestamp') or 0) <= until]
+    records = []
+    for week in range(max(week_of(since, start_day), 1), week_of(until, start_day) + 1):
+        for group in groups:
+            responses = query(db, response_path(survey_type, week, group), 'timestamp', start_at=since + 1,
+                              end_at=until)
+            records += [(week, str(group), uid, record) for uid, record in responses.items()]
+    return records
+
+
+def changed_activities(db, since, until, page_size=PAGE_SIZE):
+    # activities with a timestamp in (since, until], a page at a time; a page starts at the last
+    # timestamp of the one before, so events sharing that timestamp aren't skipped
+    activities, start = {}, (since + 1) if since is not None else None
+    while True:
+        page = query(db, 'activities', 'timestamp', start_at=start, end_at=until, limit=page_size)
+        new = {key: event for key, event in page.items() if key not in activities and isinstance(event, dict)}
+        activities.update(new)
+        if len(page) < page_size or not new:
+            return activities
+        start = max(event.get('timestamp', 0) for event in page.values())
+
+
+def read_state(out):
+    try:
+        with open(os.path.join(out, STATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'watermarks': {}, 'runs': []}
+
+
+def write_state(out, state):
+    path = os.path.join(out, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def export(db, out, schema, start_day, survey_types=('pre', 'post'), full=False, page_size=PAGE_SIZE, dry_run=False):
+    # one incremental run; the watermarks only move once every file of the run is written
+    state = {'watermarks': {}, 'runs': []} if full else read_state(out)
+    watermarks = dict(state['watermarks'])
+    # unique even for runs started in the same moment, so parts of earlier runs are never replaced
+    run = datetime.now().strftime('%Y%m%dT%H%M%S%f')[:-3] + '-' + uuid.uuid4().hex[:8]
+    until = int(t.time() * 1000) - SETTLE_MS
+    report = {'run': run, 'until': until}
+
+    users = as_dict(db.child('users').get().val())
+    groups = sorted({str(p.get('group')) for p in users.values() if isinstance(p, dict) and p.get('group')})
+    tables = {'users': users_table(users)}
+    for survey_type in survey_types:
+        name = survey_tree(survey_type)
+        records = changed_responses(db, survey_type, watermarks.get(name), until, groups, start_day)
+        tables[name] = survey_table(records, getattr(schema, survey_type))
+    tables['activities'] = activity_table(changed_activities(db, watermarks.get('activities'), until, page_size),
+                                          start_day)
+
+    for name, table in tables.items():
+        report[name] = table.num_rows
+        if name != 'users' and table.num_rows:
+            watermarks[name] = max(watermarks.get(name) or 0, pc.max(table.column('timestamp')).as_py())
+    if dry_run:
+        return report
+
+    os.makedirs(out, exist_ok=True)
+    for name, table in tables.items():
+        if name == 'users':
+            pq.write_table(table, os.path.join(out, 'users.parquet.tmp'))
+            os.replace(os.path.join(out, 'users.parquet.tmp'), os.path.join(out, 'users.parquet'))
+        elif table.num_rows:
+            report[name + '_files'] = write_partitions(table, os.path.join(out, name), run)
+    state['watermarks'] = watermarks
+    state['runs'] = state['runs'] + [report]
+    write_state(out, state)
+    return report
+
+
+def prune_activities(db, out, keep_days=None, page_size=PAGE_SIZE, dry_run=False):
+    # delete activities that were already exported (and are older than `keep_days`) from the database
+    cutoff = read_state(out)['watermarks'].get('activities')
+    if cutoff is None:
+        return {'pruned': 0}
+    if keep_days is not None:
+        cutoff = min(cutoff, int(t.time() * 1000) - keep_days * DAY_MS)
+    if dry_run:
+        return {'pruned': len(query(db, 'activities', 'timestamp', end_at=cutoff)), 'before': cutoff, 'dry_run': True}
+    pruned = 0
+    while True:  # every page deleted makes room for the next one
+        page = query(db, 'activities', 'timestamp', end_at=cutoff, limit=page_size)
+        batch_update(db, 'activities', {key: None for key in page})
+        pruned += len(page)
+        if len(page) < page_size:
+            return {'pruned': pruned, 'before': cutoff, 'dry_run': False}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export surveys, users and activities to Parquet.')
+    parser.add_argument('--out', default='exports', help='directory of the exported dataset')
+    parser.add_argument('--survey', choices=['pre', 'post'], action='append')
+    parser.add_argument('--full', action='store_true',
+                        help='ignore the watermarks and export everything again, next to the earlier files')
+    parser.add_argument('--prune-activities', action='store_true',
+                        help='afterwards delete exported activities from the database')
+    parser.add_argument('--keep-days', type=int, help='keep the activities of the last N days when pruning')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be exported or pruned')
+    args = parser.parse_args()
+    import streamlit as st
+    db = connect()
+    print(export(db, args.out, load_schema('input/survey_questions.xlsx'), course_start(st.secrets.get('start_day')),
+                 args.survey or ['pre', 'post'], full=args.full, dry_run=args.dry_run))
+    if args.prune_activities:
+        print(prune_activities(db, args.out, keep_days=args.keep_days, dry_run=args.dry_run))
@@ -0,0 +1,53 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import metrics
+
+
+def pooled_session(pool_size=32, retries=3):
+    # keep-alive connections reused by every session and rerun; only connection errors and
+    # idempotent reads are retried, so a multi-path update with increments is never sent twice
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size,
+                          max_retries=Retry(total=retries, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+class Fetcher:
+    # Reads from the Realtime Database REST API over a shared pooled session, running independent
+    # reads concurrently on a bounded thread pool. Every request has a (connect, read) timeout.
+    def __init__(self, database_url, session, max_workers=8, timeout=(5, 30)):
+        self.database_url = database_url.rstrip('/') + '/'
+        self.session = session
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='fetch')
+
+    def get(self, path, timeout=None):
+        with metrics.span('db.get', path=path) as span:
+            value, span['bytes'] = self.download(path, timeout)
+            span['records'] = metrics.record_count(value)
+        return value
+
+    def download(self, path, timeout=None):
+        # the decoded node and the size of the response body
+        response = self.session.get(self.database_url + path.strip('/') + '.json', timeout=timeout or self.timeout)
+        response.raise_for_status()
+        return response.json(), len(response.content)
+
+    def patch(self, path, values, timeout=None):
+        # multi-path update of the children of `path`; not retried by the session on a bad status
+        response = self.session.patch(self.database_url + path.strip('/') + '.json', data=json.dumps(values),
+                                      timeout=timeout or self.timeout)
+        response.raise_for_status()
+
+    def map(self, fn, calls):
+        # fn(*args) for every args tuple in calls, run concurrently; results keep the order of calls
+        calls = list(calls)
+        if len(calls) < 2:
+            return [fn(*args) for args in calls]
+        fn = metrics.bind(fn)  # spans in the workers belong to the caller's rerun
+        return [future.result() for future in [self.pool.submit(fn, *args) for args in calls]]
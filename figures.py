@@ -0,0 +1,65 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+import pandas as pd
+import plotly.graph_objects as go
+import metrics
+
+# plotly express fills figures from a template shared by every thread, and two figures built at
+# the same time can corrupt each other, so figures are built one at a time
+BUILD_LOCK = threading.Lock()
+
+
+class FigureCache:
+    # Built plotly figures as JSON, keyed by the chart's scope (e.g. survey type, week, group and
+    # question) and a hash of the data it draws; the least recently used are dropped once the JSON
+    # takes more than `max_bytes`. A hit skips building the figure and plotly's validation of it.
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (scope, data version) -> figure JSON
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, scope, data, build):
+        # the figure build(data) returns, built only when this scope hasn't drawn this data yet
+        key = (tuple(scope), data_version(data))
+        with self.lock:
+            spec = self.entries.get(key)
+            if spec is not None:
+                self.entries.move_to_end(key)
+        if spec is None:
+            with metrics.span('figure.build'):  # no scope: the goals table's scope names a student
+                with BUILD_LOCK:
+                    spec = build(data).to_json()
+            with self.lock:
+                if key not in self.entries:
+                    self.entries[key] = spec
+                    self.size += len(spec)
+                while self.size > self.max_bytes and len(self.entries) > 1:
+                    self.size -= len(self.entries.popitem(last=False)[1])
+        # built from a validated figure, so it doesn't need validating again
+        return go.Figure(json.loads(spec), _validate=False)
+
+    def invalidate(self, *scope):
+        # drop the figures of a scope and everything below it; None in a cached scope (e.g. the week
+        # of a chart over all weeks) matches any value
+        with self.lock:
+            for key in [key for key in self.entries if covers(key[0], scope)]:
+                self.size -= len(self.entries.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+def covers(cached, scope):
+    return len(cached) >= len(scope) and all(c is None or c == s for c, s in zip(cached, scope))
+
+
+def data_version(data):
+    # hash of a frame's columns, index and values
+    digest = hashlib.sha1(json.dumps([str(c) for c in data.columns]).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(data.astype(str), index=True).values.tobytes())
+    return digest.hexdigest()
@@ -5,14 +5,20 @@ import streamlit as st
 import plotly.express as px
 import numpy as np
 from datetime import datetime
-from wordcloud import WordCloud, STOPWORDS
-import matplotlib.pyplot as plt
 import plotly.graph_objects as go
-from collections import Iterable
-from collections import Counter
 import requests
 import json
-import time as t
+from cache import TreeCache
+from figures import FigureCache
+from activity_log import ActivityLog
+from replica import Replica, firebase_events
+from wordclouds import WordCloudCache
+from schema import load_schema
+from fetch import Fetcher, pooled_session
+import metrics
+from survey_store import response_path, index_path, index_frame, partition_responses, aggregate_path, aggregate_items, \
+    aggregate_counts, submission_update, terms_path, term_items, term_counts, merge_plurals, singular_forms, \
+    AGGREGATE_TREE, trend_frame, course_start, week_of
 
 # Configure page
 st.set_page_config(
@@ -42,8 +48,21 @@ firebaseConfig = {
     'measurementId': st.secrets['measurementId']
 }
 
+
+@st.experimental_singleton
+def http_session():
+    return pooled_session(pool_size=st.secrets.get('http_pool_size', 32))
+
+
+@st.experimental_singleton
+def fetcher():
+    return Fetcher(firebaseConfig['databaseURL'], http_session(), max_workers=st.secrets.get('fetch_workers', 8),
+                   timeout=(5, st.secrets.get('fetch_timeout', 30)))
+
+
 # Firebase Authenticaiton
 firebase = pyrebase.initialize_app(firebaseConfig)
+firebase.requests = http_session()  # every rerun reuses the same keep-alive connections
 auth = firebase.auth()
 
 # Database
@@ -52,17 +71,109 @@ storage = firebase.storage()
 
 # Initialisation
 bg_color = '#636EFA'  # "#856ff8"
-start_day = datetime(2022, 10, 3)  # Mon of the week
+start_day = course_start(st.secrets.get('start_day'))  # Mon of the week
 
 
 def week_no():
-    return int((datetime.today() - start_day).days / 7) + 1
+    # the current course week; the weeks before the course count as the first
+    return max(week_of(int(datetime.now().timestamp() * 1000), start_day), 1)
+
+
+@st.experimental_singleton
+def tree_cache():
+    return TreeCache(ttl=st.secrets.get('cache_ttl', 60), max_entries=st.secrets.get('cache_max_entries', 64))
+
+
+@st.experimental_singleton
+def activity_log():
+    # batches go through the pooled session with its timeouts, so a stalled connection can't hold
+    # up the worker; keys come from a Database of the log's own, whose key state isn't shared
+    keys = firebase.database()
+    return ActivityLog(lambda batch: fetcher().patch('activities', batch), keys.generate_key,
+                       batch_size=st.secrets.get('log_batch_size', 200),
+                       interval=st.secrets.get('log_interval', 2.0))
+
+
+@st.experimental_singleton
+def wordcloud_cache():
+    return WordCloudCache(bg_color, max_entries=st.secrets.get('wordcloud_cache_entries', 64))
+
+
+@st.experimental_singleton
+def figure_cache():
+    return FigureCache(max_bytes=st.secrets.get('figure_cache_mb', 32) * 1024 * 1024)
+
+
+@st.experimental_singleton
+def replica():
+    # optional live copy of the trees the pages read, kept current by the streaming API
+    if not st.secrets.get('replica_mode', False):
+        return None
+    return Replica(firebase_events(firebaseConfig['databaseURL']),
+                   ['pre-survey', 'post-survey', 'aggregates', 'terms'],
+                   stale_after=st.secrets.get('replica_stale_after', 90)).start()
+
+
+def fetch_tree(path, decode=None):
+    return fetch_trees((path, decode))[0]
+
+
+def fetch_trees(*paths):
+    # decoded snapshots of (path, decode) pairs: from the live replica when it is fresh, decoded
+    # once per replica version, otherwise from downloads shared by all sessions until they expire
+    # or are written to; the downloads a page needs are made concurrently
+    cache, live, reader = tree_cache(), replica(), fetcher()
+
+    def load(path, decode):
+        def decoded(tree):
+            if decode is not None:
+                return decode(tree)
+            return pd.DataFrame.from_dict(tree, orient='index') if tree is not None else None
+        tree = path.split('/')[0]
+        if live is not None and live.is_fresh(tree):
+            with metrics.span('tree.load', path=path, source='replica'):
+                version = live.version(tree)
+                return cache.get(path, lambda: decoded(live.get(path)), version=version)
+        with metrics.span('tree.load', path=path, source='cache'):
+            return cache.get(path, lambda: decoded(reader.get(path)))
+    return reader.map(load, paths)
+
+
+@st.experimental_singleton
+def performance():
+    # timings of recent reruns; also served to dashboards when `metrics_port` is set (on localhost
+    # unless `metrics_host` says otherwise)
+    collected = metrics.Metrics(keep=st.secrets.get('metrics_keep', 500))
+    collected.watch('activity', activity_log().stats, gauges=['queued'])
+    if st.secrets.get('metrics_port'):
+        metrics.serve(collected, int(st.secrets['metrics_port']), st.secrets.get('metrics_host', '127.0.0.1'))
+    return collected
+
+
+def user_profile(user):
+    # the logged-in user's own profile, read once per login and kept in the session
+    profile = st.session_state.get('profile')
+    if profile is None or profile.get('id') != user['localId']:
+        profile = fetcher().get('users/' + user['localId']) or {'id': user['localId']}
+        st.session_state.profile = profile
+    return profile
+
+
+def user_group(user):
+    # a profile read before the sign-up finished has no group yet, so only the group is read again
+    profile = user_profile(user)
+    if profile.get('group') is None:
+        group = fetcher().get('users/' + user['localId'] + '/group')
+        if group is not None:
+            profile['group'] = str(group)
+    return profile.get('group')
 
 
 # load data
-pre_questions = pd.read_excel('input/survey_questions.xlsx', sheet_name='pre_survey')
-post_questions = pd.read_excel('input/survey_questions.xlsx', sheet_name='post_survey')
-learning_obj = pd.read_excel('input/survey_questions.xlsx', sheet_name='learning_objectives')
+schema = load_schema('input/survey_questions.xlsx')  # compiled once, re-read only when the workbook changes
+pre_questions = schema.pre
+post_questions = schema.post
+learning_obj = schema.objectives
 
 if "login_state" not in st.session_state:
     st.session_state.login_state = False
@@ -110,7 +221,7 @@ def main():
         # show info if login
         if st.session_state.login_state:
             user = st.session_state.user
-            name = db.child('users').child(user['localId']).child("name").get().val()
+            name = user_profile(user).get('name', '')
             st.subheader("Welcome: " + name + " to Week " + str(week_no()))
             clear_login(authen_section, login_section)
             # generate menu
@@ -118,7 +229,9 @@ def main():
                      '📮 Post-survey Submission', '📊 Post-survey Results']
             pages_holder = st.sidebar.empty()
             selected_page = pages_holder.selectbox("Menu", pages)
+            metrics.label(page=selected_page)
             st.sidebar.button("Log out", on_click=log_out, key="logout_btn")
+            show_replica_status()
             if selected_page == '😃 My weekly goals/plans':
                 st.title('✦ My weekly goals/plans')
                 log('see_homepage', user)
@@ -126,8 +239,9 @@ def main():
             elif selected_page == '📮 Pre-survey Submission':
                 st.title('✦ Submit Pre-survey')
                 log('see_submit_pre_survey_page', user)
-                branchID = user['localId'] + "_" + str(week_no())
-                pre_survey_db = db.child('pre-survey').child(branchID).get().val()
+                week, group = week_no(), user_group(user)
+                branchID = response_path('pre', week, group, user['localId'])
+                pre_survey_db = fetcher().get(branchID)
                 if pre_survey_db is None:
                     st.warning("Please submit a pre-survey for this week.")
                 else:
@@ -136,25 +250,20 @@ def main():
                     response = pre_survey()
                     submitted = st.form_submit_button('Submit')
                     if submitted:
-                        time = int(datetime.now().timestamp() * 1000)
-                        db.child("pre-survey").child(branchID).child("id").set(user['localId'])
-                        db.child("pre-survey").child(branchID).child("timestamp").set(time)
-                        db.child("pre-survey").child(branchID).child("response").set(response)
-                        log('submit_pre_survey', user)
-                        info_box = st.empty()
-                        with info_box:
+                        if submit_survey(user, 'pre', week, group, response, pre_survey_db):
                             st.success(
                                 "Thank you very much! You've successfully submitted the pre-survey for this week.")
-                            t.sleep(5)
-                        info_box.empty()
+                        else:
+                            st.error("Sorry, your pre-survey couldn't be saved. Please submit it again.")
             elif selected_page == '📊 Pre-survey Results':
                 log('see_pre_survey_page', user)
                 pull_results(user, 'pre')
             elif selected_page == '📮 Post-survey Submission':
                 st.title('✦ Submit Post-survey')
                 log('see_submit_post_survey_page', user)
-                branchID = user['localId'] + "_" + str(week_no())
-                post_survey_db = db.child('post-survey').child(branchID).get().val()
+                week, group = week_no(), user_group(user)
+                branchID = response_path('post', week, group, user['localId'])
+                post_survey_db = fetcher().get(branchID)
                 if post_survey_db is None:
                     st.warning("Please submit a post-survey for this week.")
                 else:
@@ -163,17 +272,11 @@ def main():
                     response = post_survey()
                     submitted_post = st.form_submit_button('Submit')
                     if submitted_post:
-                        time = int(datetime.now().timestamp() * 1000)
-                        db.child("post-survey").child(branchID).child("id").set(user['localId'])
-                        db.child("post-survey").child(branchID).child("timestamp").set(time)
-                        db.child("post-survey").child(branchID).child("response").set(response)
-                        log('submit_post_survey', user)
-                        info_box = st.empty()
-                        with info_box:
+                        if submit_survey(user, 'post', week, group, response, post_survey_db):
                             st.success(
                                 "Thank you very much! You've successfully submitted the post-survey for this week.")
-                            t.sleep(5)
-                        info_box.empty()
+                        else:
+                            st.error("Sorry, your post-survey couldn't be saved. Please submit it again.")
             elif selected_page == '📊 Post-survey Results':
                 log('see_post_survey_page', user)
                 pull_results(user, 'post')
@@ -188,13 +291,12 @@ def main():
         if submit:
             try:  # push new user data in Firebase
                 user = auth.create_user_with_email_and_password(new_email, new_password)
-                db.child('users').child(user['localId']).child("id").set(user['localId'])
-                db.child('users').child(user['localId']).child("name").set(name)
-                db.child('users').child(user['localId']).child("email").set(new_email)
-                db.child('users').child(user['localId']).child("group").set(str(group))
-                log('signup', user)
-                st.success('Your account is created successfully!')
-                st.info('Please login via the drop down selection on the left.')
+                if create_profile(user, name, new_email, group):
+                    log('signup', user)
+                    st.success('Your account is created successfully!')
+                    st.info('Please login via the drop down selection on the left.')
+                else:
+                    st.error("Sorry, your account couldn't be created. Please try again.")
             except requests.exceptions.HTTPError as e:
                 error_json = e.args[1]
                 error = json.loads(error_json)['error']['message']
@@ -202,6 +304,56 @@ def main():
                     st.error("Email already exists. Please log in or sign up with the new email.")
 
 
+def submit_survey(user, survey_type, week, group, response, previous):
+    # one atomic round trip for the response, its index entry and its aggregate counts
+    questions = pre_questions if survey_type == 'pre' else post_questions
+    time = int(datetime.now().timestamp() * 1000)
+    update = submission_update(survey_type, week, group, user['localId'], time, response,
+                               previous.get('response') if previous is not None else None,
+                               aggregate_items(questions), term_items(questions))
+    try:
+        with metrics.span('db.update', paths=len(update)):
+            db.update(update)
+    except requests.exceptions.RequestException:
+        return False
+    tree_cache().invalidate(response_path(survey_type, week, group))
+    tree_cache().invalidate(aggregate_path(survey_type, week, group))
+    tree_cache().invalidate(terms_path(survey_type, week, group))
+    figure_cache().invalidate(survey_type, week, group)
+    figure_cache().invalidate('goals', user['localId'])
+    log('submit_' + survey_type + '_survey', user)
+    return True
+
+
+def create_profile(user, name, email, group):
+    profile = {'id': user['localId'], 'name': name, 'email': email, 'group': str(group)}
+    try:
+        with metrics.span('db.set', path='users/' + user['localId']):
+            db.child('users').child(user['localId']).set(profile)
+    except requests.exceptions.RequestException:
+        # without a profile the account can't be used, so take it back and let the student sign up again
+        try:
+            auth.delete_user_account(user['idToken'])
+        except requests.exceptions.RequestException:
+            pass
+        return False
+    st.session_state.profile = profile
+    return True
+
+
+def show_replica_status():
+    live = replica()
+    if live is None:
+        return
+    ages = [live.age(tree) for tree in live.data]
+    if all(age is not None and age < live.stale_after for age in ages):
+        st.sidebar.caption("🟢 Live data")
+    elif any(age is None for age in ages):
+        st.sidebar.caption("🟠 Live data is reconnecting; reading from the database")
+    else:
+        st.sidebar.caption("🟠 Live data is " + str(int(max(ages))) + "s behind; reading from the database")
+
+
 def print_status():
     st.sidebar.write("session state:", st.session_state)
     st.sidebar.write("auth:", auth.current_user)
@@ -213,12 +365,14 @@ def log(action, user):
         'activity': action,
         'id': user['localId']
     }
-    result = db.child('activities').push(data, user['localId'])
+    activity_log().log(data)
 
 
 def log_out():
     log('logout', st.session_state.user)
+    activity_log().flush()
     st.session_state.user = None
+    st.session_state.profile = None
     st.session_state.login_state = False
     st.success("You've logged out.")
     # print_status()
@@ -240,47 +394,59 @@ def clear_login(authen_section, login_section):
 def pre_survey():
     response = {}
     theme = ""
-    for ind, q in pre_questions.iterrows():
-        item = 'q' + str(q['No'])
-        if theme != q['Category']:
-            st.markdown("### 📌 " + q['Category'])
-            theme = q['Category']
-        if q['ChoiceType'] == 'select_slider':
-            response[item] = st.select_slider(q['Question'], q['Choice'].split(';'))
-        elif q['ChoiceType'] == 'text_input':
-            response[item] = st.text_input(q['Question'])
-        elif q['ChoiceType'] == 'multiselect':
-            response[item] = st.multiselect(q['Question'], q['Choice'].split(';'))
-        elif q['ChoiceType'] == 'selectbox':
-            response[item] = st.selectbox(q['Question'], learning_obj.loc[week_no() - 1, 'LearningObjective'].split(';'))
+    for q in pre_questions:
+        item = q.item
+        if theme != q.category:
+            st.markdown("### 📌 " + q.category)
+            theme = q.category
+        if q.choice_type == 'select_slider':
+            response[item] = st.select_slider(q.question, q.choices)
+        elif q.choice_type == 'text_input':
+            response[item] = st.text_input(q.question)
+        elif q.choice_type == 'multiselect':
+            response[item] = st.multiselect(q.question, q.choices)
+        elif q.choice_type == 'selectbox':
+            response[item] = st.selectbox(q.question, learning_obj.get(week_no(), ()))
     return response
 
 
 def post_survey():
     response = {}
     theme = ""
-    for ind, q in post_questions.iterrows():
-        item = 'q' + str(q['No'])
-        if theme != q['Category']:
-            st.markdown("### 📌 " + q['Category'])
-            theme = q['Category']
-        if q['ChoiceType'] == 'select_slider':
-            response[item] = st.select_slider(q['Question'], q['Choice'].split(';'))
-        elif q['ChoiceType'] == 'text_input':
-            response[item] = st.text_input(q['Question'])
-        elif q['ChoiceType'] == 'multiselect':  # this can be null and no field at all
-            temp = st.multiselect(q['Question'], q['Choice'].split(';'))
+    for q in post_questions:
+        item = q.item
+        if theme != q.category:
+            st.markdown("### 📌 " + q.category)
+            theme = q.category
+        if q.choice_type == 'select_slider':
+            response[item] = st.select_slider(q.question, q.choices)
+        elif q.choice_type == 'text_input':
+            response[item] = st.text_input(q.question)
+        elif q.choice_type == 'multiselect':  # this can be null and no field at all
+            temp = st.multiselect(q.question, q.choices)
             response[item] = temp if temp != [] else ""
     return response
 
 
+@metrics.timed('pull_results')
 def pull_results(user, survey_type):
     # fetch user data
-    users_db = db.child('users').get().val()
-    users = pd.DataFrame.from_dict(users_db, orient='index')
-    group = users.loc[users['id'] == user['localId'], 'group'].values[0]
+    group = user_group(user)
 
     # show options
+    if survey_type == 'pre':
+        questions = pre_questions
+    elif survey_type == 'post':
+        questions = post_questions
+    view = st.radio("Show the group results of:", ['One week', 'All weeks'], horizontal=True,
+                    key=survey_type + '-view')
+    if view == 'All weeks':
+        if st.session_state.get(survey_type + '_view') != view:
+            log('see_' + survey_type + '_survey_trends', user)
+        st.session_state[survey_type + '_view'] = view
+        pull_trends(survey_type, group, questions)
+        return
+    st.session_state[survey_type + '_view'] = view
     if 'pre_week' not in st.session_state:
         st.session_state.pre_week = week_no()
     if 'post_week' not in st.session_state:
@@ -294,30 +460,14 @@ def pull_results(user, survey_type):
     if survey_type == 'post' and selected_week != st.session_state.post_week:
         log("select_post_survey_week_" + str(selected_week), user)
         st.session_state.post_week = selected_week
-    weeks_ind = pd.date_range(start_day, periods=10, freq='W-MON')
-    # st.write("Select from this day:" + str(weeks_ind[selected_week-1]) + "to before this day:"+ str(weeks_ind[selected_week]))
-
-    # fetch survey db
-    if survey_type == 'pre':
-        survey_db = db.child('pre-survey').get().val()
-        questions = pre_questions
-    elif survey_type == 'post':
-        survey_db = db.child('post-survey').get().val()
-        questions = post_questions
 
-    # prep data for display
-    if survey_db is not None:
-        survey = pd.DataFrame.from_dict(survey_db, orient='index')
-        survey_data = survey.merge(users[["id", "group"]], on="id", how="left")
-        survey_data["date"] = survey_data['timestamp'].apply(lambda x: datetime.fromtimestamp(x / 1000))
-    else:
-        survey_data = None
+    # fetch only the partition of the selected week and group
+    survey_data, counts, words = fetch_trees((response_path(survey_type, selected_week, group), partition_responses),
+                                             (aggregate_path(survey_type, selected_week, group), aggregate_counts),
+                                             (terms_path(survey_type, selected_week, group), term_counts))
 
     num_survey = 0
     if survey_data is not None:
-        survey_data = survey_data[(survey_data["group"] == group) &
-                                  (survey_data['date'] >= weeks_ind[selected_week - 1]) &
-                                  (survey_data['date'] < weeks_ind[selected_week])]
         num_survey = len(survey_data)
     if survey_type == 'pre':
         st.title("✦ Pre-survey results of Group: " + group + " | No. of responses: " + str(num_survey))
@@ -328,127 +478,160 @@ def pull_results(user, survey_type):
     if survey_data is None:#survey_data.empty:
         st.write("No response in the selected period.")
     else:
-        results = pd.DataFrame()
-        for key, val in survey_data.response.items():
-            temp = pd.DataFrame.from_dict(val, orient='index')  # individual response
-            # results = results.append(temp.T, ignore_index=True) #depreciated
-            results = pd.concat([results, temp.T])
-
         # show result
-        if not results.empty:
+        if not survey_data.empty:
             theme = ""
-            for ind, q in questions.iterrows():
-                item = 'q' + str(q['No'])
+            clouds = []
+            for q in questions:
+                item = q.item
                 # print category title
-                if theme != q['ShortQuestion']:
-                    st.markdown("### 📌 " + q['ShortQuestion'])
-                    theme = q['ShortQuestion']
-                st.markdown("> " + q['Question'])
+                if theme != q.short:
+                    st.markdown("### 📌 " + q.short)
+                    theme = q.short
+                st.markdown("> " + q.question)
 
                 # show visualisation
-                if q['Chart'] == 'bar':  # bar chart
-                    data = results[item].value_counts().reindex(q['Choice'].split(';')).reset_index(level=0)
-                    data.insert(loc=0, column='Rank', value=np.arange(len(data)) + 1)
-                    data = data.rename({'index': q['ShortQuestion'], item: 'Count'}, axis='columns')
-                    if data is not None:
-                        fig = px.bar(data, x=q['ShortQuestion'], y='Count')
-                        fig.update_yaxes(visible=False, showticklabels=False)  # no y axis
-                        fig.update_xaxes(title="")
-                        fig.update_layout({'plot_bgcolor': 'rgba(0, 0, 0, 0)', 'paper_bgcolor': 'rgba(0, 0, 0, 0)',
-                                           'font_size': 16})  # no bg
-                        fig.update_traces(marker_line_width=0)  # no stroke
-                        st.plotly_chart(fig, use_container_width=True)
-                    else:
-                        st.write("No data")
-                elif q['Chart'] == 'pie':  # pie chart
-                    data = results[item].value_counts().reset_index(level=0)
-                    data.insert(loc=0, column='Rank', value=np.arange(len(data)) + 1)
-                    data = data.rename({'index': q['ShortQuestion'], item: 'Count'}, axis='columns')
-                    if data is not None:
-                        fig = px.pie(data, values='Count', names=q['ShortQuestion'])
-                        fig.update_layout(font_size=16)
-                        st.plotly_chart(fig, use_container_width=True)
-                    else:
-                        st.write("No data")
-                elif q['Chart'] == 'bar-h':  # for multi-selected questions, display horizontal bar
-                    strategy_lists = list(flatten(results[item]))
-                    data = pd.DataFrame.from_dict(Counter(strategy_lists), orient='index').reset_index(level=0)
-                    data = data.rename({'index': q['ShortQuestion'], 0: 'Count'}, axis='columns').sort_values('Count',
-                                                                                                              ascending=False)
-                    if data is not None:
-                        fig = px.bar(data, y=q['ShortQuestion'], x='Count', orientation='h')
-                        fig.update_layout(
-                            {'plot_bgcolor': 'rgba(0, 0, 0, 0)', 'paper_bgcolor': 'rgba(0, 0, 0, 0)'})  # no bg
-                        fig.update_traces(marker_line_width=0)  # no stroke
-                        fig.update_xaxes(visible=False, showticklabels=False)
-                        # fig.update_yaxes(title="", categoryorder='total ascending')
-                        fig.update_layout(font_size=16)
-                        st.plotly_chart(fig, use_container_width=True)
-                    else:
-                        st.write("No data")
-                elif q['Chart'] == 'wordcloud':
-                    data = results[item]
-                    text = ' '.join(filter(None, data))
-                    if text == "":
-                        c, c1, c2 = st.columns([0.1, 1, 2])
-                        with c1:
+                with metrics.span('chart.' + q.chart, item=item):
+                    if q.chart == 'bar':  # bar chart
+                        data = item_counts(counts, item).reindex(q.choices).reset_index(level=0)
+                        data.insert(loc=0, column='Rank', value=np.arange(len(data)) + 1)
+                        data = data.rename({'index': q.short, item: 'Count'}, axis='columns')
+                        if data is not None:
+                            fig = figure_cache().get((survey_type, selected_week, group, item), data,
+                                                     lambda data: bar_figure(data, q))
+                            st.plotly_chart(fig, use_container_width=True)
+                        else:
                             st.write("No data")
-                    else:
+                    elif q.chart == 'pie':  # pie chart
+                        data = item_counts(counts, item).sort_values(ascending=False).reset_index(level=0)
+                        data.insert(loc=0, column='Rank', value=np.arange(len(data)) + 1)
+                        data = data.rename({'index': q.short, item: 'Count'}, axis='columns')
+                        if data is not None:
+                            fig = figure_cache().get((survey_type, selected_week, group, item), data,
+                                                     lambda data: pie_figure(data, q))
+                            st.plotly_chart(fig, use_container_width=True)
+                        else:
+                            st.write("No data")
+                    elif q.chart == 'bar-h':  # for multi-selected questions, display horizontal bar
+                        data = item_counts(counts, item).reset_index(level=0)
+                        data = data.rename({'index': q.short, item: 'Count'}, axis='columns').sort_values(
+                            'Count', ascending=False)
+                        if data is not None:
+                            fig = figure_cache().get((survey_type, selected_week, group, item), data,
+                                                     lambda data: hbar_figure(data, q))
+                            st.plotly_chart(fig, use_container_width=True)
+                        else:
+                            st.write("No data")
+                    elif q.chart == 'wordcloud':
+                        answers = [i for i in survey_data.get(item, ()) if isinstance(i, str) and i != '']
                         c, c1, c2 = st.columns([0.1, 1, 2])
-                        with c1:
-                            s = ''
-                            for i in data:
-                                if i != '':
-                                    s += "- " + i + "\n"
-                            st.markdown(s)
-                        with c2:
-                            try:
-                                wordcloud = WordCloud(background_color=bg_color, colormap='Set3', stopwords=STOPWORDS,
-                                                      random_state=1, collocations=False, mode='RGBA').generate(text)
-                                fig, ax = plt.subplots(figsize=(12, 8))
-                                fig.patch.set_visible(False)
-                                plt.axis("off")
-                                ax.imshow(wordcloud, interpolation='bilinear')
-                                plt.show()
-                                st.pyplot(fig)
-                            except ValueError as ve:
-                                st.error("No word cloud to show.")
+                        if not answers:
+                            with c1:
+                                st.write("No data")
+                        else:
+                            with c1:
+                                st.markdown('\n'.join("- " + i for i in answers))
+                            # drawn off-thread from the group-week's word counts; filled in once the rest
+                            # of the page is out
+                            clouds.append((c2.empty(), wordcloud_cache().get((survey_type, item, selected_week, group),
+                                                                             merge_plurals(words.get(item, {})))))
+
+            for slot, cloud in clouds:
+                with metrics.span('wordcloud.wait'):
+                    try:
+                        png = cloud.result()
+                    except Exception:  # tried again on the next view
+                        png = None
+                if png is None:
+                    slot.error("No word cloud to show.")
+                else:
+                    slot.image(png, use_column_width=True)
+
+            if st.checkbox("🔤 Show top terms across weeks", key=survey_type + '-top-terms'):
+                show_top_terms(survey_type, group, questions)
 
 
+@metrics.timed('pull_trends')
+def pull_trends(survey_type, group, questions):
+    # how the group's answers changed over the weeks, from one table of every week's counts that is
+    # rebuilt only when the survey's aggregates change
+    trends = fetch_tree(AGGREGATE_TREE + '/' + survey_type, trend_frame)
+    trends = trends[trends['group'] == str(group)]
+    title = "✦ Pre-survey trends of Group: " if survey_type == 'pre' else "✦ Post-survey trends of Group: "
+    st.title(title + group + " | Weeks: " + str(trends['week'].nunique()))
+    if trends.empty:
+        st.write("No response in the selected period.")
+        return
+    theme = ""
+    for q in questions:
+        if q.chart == 'wordcloud':
+            continue
+        if theme != q.short:
+            st.markdown("### 📌 " + q.short)
+            theme = q.short
+        st.markdown("> " + q.question)
+        with metrics.span('chart.trend-' + q.chart, item=q.item):
+            data = trends[trends['item'] == q.item].rename(columns={'week': 'Week', 'choice': q.short,
+                                                                    'count': 'Count', 'share': 'Share'})
+            if data.empty:
+                st.write("No data")
+                continue
+            # week None: drawn over all weeks
+            fig = figure_cache().get((survey_type, None, group, q.item), data, lambda data: trend_figure(data, q))
+            st.plotly_chart(fig, use_container_width=True)
+    if st.checkbox("🔤 Show top terms across weeks", key=survey_type + '-top-terms'):
+        show_top_terms(survey_type, group, questions)
+
+
+@metrics.timed('chart.top-terms')
+def show_top_terms(survey_type, group, questions, top=10):
+    # the group's most used words in each free-text question over the weeks so far, from the word counts;
+    # it reads every week, so the results pages only show it when it is asked for
+    weeks = list(range(1, week_no() + 1))
+    trees = fetch_trees(*[(terms_path(survey_type, week, group), term_counts) for week in weeks])
+    for q in questions:
+        if q.chart != 'wordcloud':
+            continue
+        st.markdown("> " + q.question)
+        data = pd.DataFrame([(week, term, n) for week, counts in zip(weeks, trees)
+                             for term, n in counts.get(q.item, {}).items()], columns=['Week', q.short, 'Count'])
+        if data.empty:
+            st.write("No data")
+            continue
+        data[q.short] = data[q.short].replace(singular_forms(data[q.short]))
+        top_terms = data.groupby(q.short)['Count'].sum().nlargest(top).index
+        data = data[data[q.short].isin(top_terms)].groupby(['Week', q.short], as_index=False)['Count'].sum()
+        data['Week'] = 'Week ' + data['Week'].astype(str)
+        fig = figure_cache().get((survey_type, None, group, q.item, 'terms'), data,
+                                 lambda data: terms_figure(data, q))
+        st.plotly_chart(fig, use_container_width=True)
+
+
+@metrics.timed('pull_goals')
 def pull_goals(user):
     # fetch user data|pre:q5,q6|post:q19
     id = user['localId']
 
-    # fetch pre-survey data
-    start_week = start_day.isocalendar().week
-    pre_survey_db = db.child('pre-survey').get().val()
-    if pre_survey_db is not None:
-        pre_surveys = pd.DataFrame.from_dict(pre_survey_db, orient='index')
-        pre_surveys = pre_surveys[pre_surveys.id == id]
-        if not pre_surveys.empty:
-            pre_surveys['date'] = pre_surveys['timestamp'].apply(lambda x: datetime.fromtimestamp(x / 1000))#this is british time, not utc
-            pre_surveys['week'] = pre_surveys['date'].dt.week - start_week + 1
-            response = pd.json_normalize(pre_surveys.response)
-            # construct new var for visualise
-            my_data = pd.DataFrame()
-            my_data['Week'] = pre_surveys.week.reset_index(drop=True)
-            my_data['Pre-goals'] = response.q5
-            my_data['Pre-plans'] = response.q6
-
-    # fetch post-survey data
-    post_survey_db = db.child('post-survey').get().val()
-    if post_survey_db is not None:
-        post_surveys = pd.DataFrame.from_dict(post_survey_db, orient='index')
-        post_surveys = post_surveys[post_surveys.id == id]
-        if not post_surveys.empty:
-            post_surveys['date'] = post_surveys['timestamp'].apply(lambda x: datetime.fromtimestamp(x / 1000))
-            post_surveys['week'] = post_surveys['date'].dt.week - start_week + 1
-            response = pd.json_normalize(post_surveys.response)
-
-            # construct new var for visualise
-            my_data_post = pd.DataFrame()
-            my_data_post['Week'] = post_surveys.week.reset_index(drop=True)
-            my_data_post['Follow-up plans'] = response.q19
+    # fetch this user's own responses from the per-user index
+    live = replica()
+    if live is not None and live.is_fresh('pre-survey', 'post-survey'):
+        index = live.user_index(id)
+    else:
+        index = fetcher().get(index_path(id))
+    pre_surveys = index_frame(index, 'pre')
+    if pre_surveys is not None:
+        # construct new var for visualise
+        my_data = pd.DataFrame()
+        my_data['Week'] = pre_surveys.week
+        my_data['Pre-goals'] = pre_surveys.q5
+        my_data['Pre-plans'] = pre_surveys.q6
+
+    post_surveys = index_frame(index, 'post')
+    if post_surveys is not None:
+        # construct new var for visualise
+        my_data_post = pd.DataFrame()
+        my_data_post['Week'] = post_surveys.week
+        my_data_post['Follow-up plans'] = post_surveys.q19
 
     # table_data = pd.DataFrame(columns=['Week', 'Pre-goals', 'Pre-plans', 'Follow-up plans'])
     if 'my_data' not in locals():
@@ -458,6 +641,11 @@ def pull_goals(user):
 
     all_data = pd.merge(my_data, my_data_post, on='Week', how='outer')
     all_data = all_data.fillna("-")
+    fig = figure_cache().get(('goals', id), all_data, goals_table)
+    st.plotly_chart(fig, use_container_width=True)
+
+
+def goals_table(all_data):
     fig = go.Figure(data=[go.Table(
         columnwidth=[0.8, 3, 4, 4],
         header=dict(values=all_data.columns,
@@ -475,20 +663,96 @@ def pull_goals(user):
                    line_width=0,
                    font=dict(color='white', size=14)))])
     fig.update_layout(margin=dict(l=2, r=2, b=2, t=2))
-    st.plotly_chart(fig, use_container_width=True)
-
-
-def flatten(lis):
-    for item in lis:
-        if isinstance(item, Iterable) and not isinstance(item, str):
-            for x in flatten(item):
-                yield x
-        else:
-            yield item
+    return fig
+
+
+def bar_figure(data, q):
+    fig = px.bar(data, x=q.short, y='Count')
+    fig.update_yaxes(visible=False, showticklabels=False)  # no y axis
+    fig.update_xaxes(title="")
+    fig.update_layout({'plot_bgcolor': 'rgba(0, 0, 0, 0)', 'paper_bgcolor': 'rgba(0, 0, 0, 0)',
+                       'font_size': 16})  # no bg
+    fig.update_traces(marker_line_width=0)  # no stroke
+    return fig
+
+
+def pie_figure(data, q):
+    fig = px.pie(data, values='Count', names=q.short)
+    fig.update_layout(font_size=16)
+    return fig
+
+
+def hbar_figure(data, q):
+    fig = px.bar(data, y=q.short, x='Count', orientation='h')
+    fig.update_layout({'plot_bgcolor': 'rgba(0, 0, 0, 0)', 'paper_bgcolor': 'rgba(0, 0, 0, 0)'})  # no bg
+    fig.update_traces(marker_line_width=0)  # no stroke
+    fig.update_xaxes(visible=False, showticklabels=False)
+    # fig.update_yaxes(title="", categoryorder='total ascending')
+    fig.update_layout(font_size=16)
+    return fig
+
+
+def trend_figure(data, q):
+    if q.chart in ('bar', 'pie'):  # how the answers were spread each week
+        order = list(q.choices) + sorted(set(data[q.short]) - set(q.choices))
+        fig = px.bar(data, x='Week', y='Share', color=q.short, barmode='stack',
+                     category_orders={q.short: order}, hover_data=['Count'])
+        fig.update_yaxes(tickformat='.0%', title="")
+    else:  # bar-h: how often each choice was picked, week by week
+        fig = px.line(data.sort_values('Week'), x='Week', y='Count', color=q.short, markers=True)
+        fig.update_yaxes(title="")
+    fig.update_xaxes(dtick=1)
+    fig.update_layout({'plot_bgcolor': 'rgba(0, 0, 0, 0)', 'paper_bgcolor': 'rgba(0, 0, 0, 0)',
+                       'font_size': 16})  # no bg
+    return fig
+
+
+def terms_figure(data, q):
+    fig = px.bar(data, y=q.short, x='Count', color='Week', orientation='h')
+    fig.update_layout({'plot_bgcolor': 'rgba(0, 0, 0, 0)', 'paper_bgcolor': 'rgba(0, 0, 0, 0)'})  # no bg
+    fig.update_traces(marker_line_width=0)  # no stroke
+    fig.update_yaxes(title="", categoryorder='total ascending')
+    fig.update_layout(font_size=16)
+    return fig
+
+
+def item_counts(counts, item):
+    # counts per choice of one question, from the group-week aggregates
+    return counts.get(item, pd.Series(dtype='int64', name=item))
+
+
+def show_performance(rerun):
+    # opt-in timings of the rerun that just finished, for the admins listed in the `admins` secret
+    user = st.session_state.get('user') if st.session_state.login_state else None
+    if user is None or user.get('email') not in st.secrets.get('admins', []):
+        return
+    if not st.sidebar.checkbox('Show performance', key='show_performance'):
+        return
+    finished = rerun.to_dict()
+    with st.sidebar.expander('⏱ Performance', expanded=True):
+        st.write("This rerun: %.0f ms, %.1f kB in %d records downloaded" % (
+            finished['ms'], finished['counters'].get('bytes', 0) / 1024, finished['counters'].get('records', 0)))
+        log_stats = activity_log().stats()
+        st.write("Activity log: %d queued, %d written, %d dropped, %d retries" % (
+            log_stats['queued'], log_stats['written'], log_stats['dropped'], log_stats['retries']))
+        if finished['spans']:
+            spans = pd.DataFrame(finished['spans'])
+            st.dataframe(spans.groupby('name')['ms'].agg(['count', 'sum', 'max']).sort_values('sum', ascending=False))
+            st.dataframe(spans.drop(columns='name').set_index(spans['name']))
+        st.download_button('Download JSON lines', performance().json_lines(), file_name='dute-metrics.jsonl')
+        st.download_button('Download Prometheus text', performance().prometheus(), file_name='dute-metrics.prom')
 
 
 if __name__ == "__main__":
-    main()
+    # every rerun is timed; spans from the page code and the download workers are collected in `rerun`
+    rerun = metrics.Rerun()
+    try:
+        with metrics.active(rerun):
+            main()
+    finally:
+        rerun.finish()
+        performance().record(rerun)
+    show_performance(rerun)
 
 ### EXPANDER
 # if 'is_expanded' not in st.session_state:
@@ -0,0 +1,208 @@
+import functools
+import json
+import re
+import threading
+import time as t
+from collections import Counter, deque
+from contextlib import contextmanager
+
+# Timing spans and download counters collected per script rerun. The rerun being measured is held
+# per thread: `active()` sets it for the script thread and `bind()` carries it into worker threads.
+# Outside a measured rerun (the CLI, the activity log worker) spans and labels are no-ops.
+_local = threading.local()
+# path segments kept in span fields; any other (a uid, a push key) is recorded as '*', so the
+# exported timings don't identify students
+SHARED_SEGMENT = re.compile(r'^(?:week-\d+|group-[^/]+|pre|post|group|responses)$')
+
+
+class Rerun:
+    def __init__(self):
+        self.started = t.time()
+        self.start = t.perf_counter()
+        self.ms = None
+        self.labels = {}
+        self.spans = []  # {'name', 'ms', ...fields} in the order they finished
+        self.counters = Counter()
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+            for field in ('bytes', 'records'):
+                if span.get(field):
+                    self.counters[field] += span[field]
+
+    def finish(self):
+        self.ms = (t.perf_counter() - self.start) * 1000
+
+    def to_dict(self):
+        with self.lock:
+            return {'time': self.started, 'ms': self.ms, **self.labels, 'counters': dict(self.counters),
+                    'spans': list(self.spans)}
+
+
+def current():
+    return getattr(_local, 'rerun', None)
+
+
+@contextmanager
+def active(rerun):
+    previous = current()
+    _local.rerun = rerun
+    try:
+        yield rerun
+    finally:
+        _local.rerun = previous
+
+
+@contextmanager
+def span(name, **fields):
+    # times the block; the yielded dict takes extra fields, e.g. bytes and records downloaded
+    rerun = current()
+    entry = dict(fields, name=name)
+    if 'path' in entry:
+        entry['path'] = partition(entry['path'])
+    if rerun is None:
+        yield entry
+        return
+    start = t.perf_counter()
+    try:
+        yield entry
+    finally:
+        entry['ms'] = (t.perf_counter() - start) * 1000
+        rerun.add(entry)
+
+
+def partition(path):
+    # the tree and partition a path lies in, without the user it belongs to
+    parts = path.strip('/').split('/')
+    return '/'.join(parts[:1] + [part if SHARED_SEGMENT.match(part) else '*' for part in parts[1:]])
+
+
+def timed(name):
+    # decorator wrapping every call of a function in a span
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def label(**labels):
+    rerun = current()
+    if rerun is not None:
+        rerun.labels.update(labels)
+
+
+def bind(fn):
+    # fn that runs in the caller's rerun from whichever thread calls it
+    rerun = current()
+    if rerun is None:
+        return fn
+
+    def bound(*args, **kwargs):
+        with active(rerun):
+            return fn(*args, **kwargs)
+    return bound
+
+
+def record_count(value):
+    # records in a downloaded node: its children, or one for a leaf
+    if value is None:
+        return 0
+    return len(value) if isinstance(value, (dict, list)) else 1
+
+
+class Metrics:
+    # Process-wide totals per span name and the last `keep` reruns, exported as JSON lines or in the
+    # Prometheus text format
+    def __init__(self, keep=500, prefix='dute'):
+        self.prefix = prefix
+        self.reruns = deque(maxlen=keep)
+        self.totals = {}  # span name -> [count, total ms, max ms]
+        self.counters = Counter()
+        self.count = 0
+        self.ms = 0.0
+        self.watched = []  # (name, stats function, gauge keys) exported with the totals
+        self.lock = threading.Lock()
+
+    def watch(self, name, stats, gauges=()):
+        # also export stats(), a {key: number} of e.g. a background worker, as <prefix>_<name>_<key>_total
+        # counters, or as gauges for the keys in `gauges`
+        with self.lock:
+            self.watched.append((name, stats, set(gauges)))
+
+    def record(self, rerun):
+        entry = rerun.to_dict()
+        with self.lock:
+            self.reruns.append(entry)
+            self.count += 1
+            self.ms += entry['ms'] or 0
+            self.counters.update(entry['counters'])
+            for s in entry['spans']:
+                total = self.totals.setdefault(s['name'], [0, 0.0, 0.0])
+                total[0] += 1
+                total[1] += s['ms']
+                total[2] = max(total[2], s['ms'])
+
+    def json_lines(self):
+        with self.lock:
+            return ''.join(json.dumps(entry, default=str) + '\n' for entry in self.reruns)
+
+    def prometheus(self):
+        p = self.prefix
+        with self.lock:
+            lines = ['# HELP %s_reruns_total Script reruns measured.' % p, '# TYPE %s_reruns_total counter' % p,
+                     '%s_reruns_total %d' % (p, self.count),
+                     '# HELP %s_rerun_seconds_total Time spent in measured reruns.' % p,
+                     '# TYPE %s_rerun_seconds_total counter' % p, '%s_rerun_seconds_total %.6f' % (p, self.ms / 1000),
+                     '# HELP %s_span_seconds Time spent in each kind of span.' % p,
+                     '# TYPE %s_span_seconds summary' % p]
+            for name, (count, ms, _) in sorted(self.totals.items()):
+                lines.append('%s_span_seconds_sum{span="%s"} %.6f' % (p, name, ms / 1000))
+                lines.append('%s_span_seconds_count{span="%s"} %d' % (p, name, count))
+            lines += ['# HELP %s_span_max_seconds Longest span of each kind.' % p,
+                      '# TYPE %s_span_max_seconds gauge' % p]
+            lines += ['%s_span_max_seconds{span="%s"} %.6f' % (p, name, peak / 1000)
+                      for name, (_, _, peak) in sorted(self.totals.items())]
+            for field in ('bytes', 'records'):
+                lines += ['# HELP %s_downloaded_%s_total %s downloaded from the database.' % (p, field, field.title()),
+                          '# TYPE %s_downloaded_%s_total counter' % (p, field),
+                          '%s_downloaded_%s_total %d' % (p, field, self.counters[field])]
+            watched = list(self.watched)
+        for name, stats, gauges in watched:
+            for key, value in sorted(stats().items()):
+                metric = '%s_%s_%s' % (p, name, key) + ('' if key in gauges else '_total')
+                lines += ['# TYPE %s %s' % (metric, 'gauge' if key in gauges else 'counter'), '%s %d' % (metric, value)]
+        return '\n'.join(lines) + '\n'
+
+
+def serve(metrics, port, host='127.0.0.1'):
+    # /metrics in the Prometheus text format and /metrics.jsonl with the recent reruns, on a daemon
+    # thread; unauthenticated, so only on the loopback interface unless another host is given
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body, kind = metrics.prometheus(), 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.jsonl':
+                body, kind = metrics.json_lines(), 'application/x-ndjson'
+            else:
+                self.send_error(404)
+                return
+            body = body.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', kind)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,167 @@
+import copy
+import json
+import threading
+import time as t
+import requests
+from survey_store import partition_records, week_key
+
+SURVEY_TREES = ['pre-survey', 'post-survey']
+
+
+class StreamClosed(Exception):
+    pass
+
+
+class Replica:
+    # In-memory copy of a few Firebase trees, kept current by one streaming listener per tree.
+    # `source(tree)` yields pyrebase-style stream events ({'event': 'put'|'patch'|..., 'path', 'data'}).
+    # A new connection starts with a put of the whole tree, so reconnecting also resyncs. A tree is
+    # fresh once it has synced and has heard from the server (data or keep-alive) in `stale_after` seconds.
+    def __init__(self, source, trees, stale_after=90, backoff=1.0, max_backoff=60.0):
+        self.source = source
+        self.stale_after = stale_after
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.data = {tree: None for tree in trees}
+        self.synced = {tree: False for tree in trees}
+        self.received = {tree: None for tree in trees}  # time of the last event
+        self.versions = {tree: 0 for tree in trees}
+        self.reconnects = {tree: 0 for tree in trees}
+        self.indexes = {}  # survey tree -> (version, uid -> [(week, record)])
+        self.lock = threading.RLock()
+        self.threads = []
+
+    def start(self):
+        for tree in self.data:
+            thread = threading.Thread(target=self._follow, args=(tree,), name='replica-' + tree, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def apply(self, tree, event):
+        kind = event.get('event')
+        with self.lock:
+            self.received[tree] = t.time()
+            if kind == 'put':
+                if event['path'] == '/':
+                    self.synced[tree] = True
+                self._set(tree, event['path'], event.get('data'))
+            elif kind == 'patch':
+                for key, value in (event.get('data') or {}).items():
+                    self._set(tree, event['path'].rstrip('/') + '/' + key, value)
+            elif kind in ('cancel', 'auth_revoked'):
+                self.synced[tree] = False
+                raise StreamClosed(kind)
+            else:
+                return  # keep-alive
+            self.versions[tree] += 1
+
+    def get(self, path):
+        # a copy of the node at `path`, safe to read while events keep arriving
+        parts = path.strip('/').split('/')
+        with self.lock:
+            node = self.data.get(parts[0])
+            for part in parts[1:]:
+                node = node.get(part) if isinstance(node, dict) else None
+            return copy.deepcopy(node)
+
+    def version(self, tree):
+        # changes with every event applied to the tree
+        with self.lock:
+            return self.versions[tree]
+
+    def user_index(self, uid):
+        # a user's responses in the same shape as their user-responses index entry
+        index = {}
+        with self.lock:
+            for tree in SURVEY_TREES:
+                for week, record in self._by_user(tree).get(uid, []):
+                    entry = {'timestamp': record.get('timestamp'), 'response': record.get('response')}
+                    index.setdefault(tree.split('-')[0], {})[week_key(week)] = entry
+            return copy.deepcopy(index)
+
+    def is_fresh(self, *trees):
+        return all(self.age(tree) is not None and self.age(tree) < self.stale_after for tree in trees)
+
+    def age(self, tree):
+        # seconds since the tree last heard from the server, None until it has synced
+        with self.lock:
+            if not self.synced.get(tree) or self.received.get(tree) is None:
+                return None
+            return t.time() - self.received[tree]
+
+    def status(self):
+        return {tree: {'synced': self.synced[tree], 'age': self.age(tree), 'version': self.versions[tree],
+                       'reconnects': self.reconnects[tree]} for tree in self.data}
+
+    def _follow(self, tree):
+        delay = self.backoff
+        while True:
+            try:
+                for event in self.source(tree):
+                    self.apply(tree, event)
+                    delay = self.backoff
+            except Exception:  # dropped connection, timeout or cancel: reconnect and resync
+                pass
+            with self.lock:
+                self.synced[tree] = False
+                self.reconnects[tree] += 1
+            t.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+
+    def _set(self, tree, path, value):
+        parts = [p for p in path.strip('/').split('/') if p]
+        if not parts:
+            self.data[tree] = value
+            return
+        if not isinstance(self.data[tree], dict):
+            self.data[tree] = {}
+        node, trail = self.data[tree], []
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            trail.append((node, part))
+            node = node[part]
+        if value is None:
+            node.pop(parts[-1], None)
+            # Firebase drops nodes left without children
+            for parent, part in reversed(trail):
+                if parent[part]:
+                    break
+                del parent[part]
+        else:
+            node[parts[-1]] = value
+
+    def _by_user(self, tree):
+        with self.lock:
+            version = self.versions[tree]
+            cached = self.indexes.get(tree)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            by_user = {}
+            for week, _, uid, record in partition_records(self.data.get(tree)):
+                by_user.setdefault(uid, []).append((week, record))
+            self.indexes[tree] = (version, by_user)
+            return by_user
+
+
+def firebase_events(database_url, session=None, timeout=(10, 90)):
+    # stream source reading the Realtime Database REST streaming API; the read timeout is longer
+    # than the server's 30s keep-alive, so a silent connection is dropped and reopened
+    session = session or requests.Session()
+
+    def events(tree):
+        url = database_url.rstrip('/') + '/' + tree + '.json'
+        with session.get(url, headers={'Accept': 'text/event-stream'}, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            kind = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith('event:'):
+                    kind = line[len('event:'):].strip()
+                elif line.startswith('data:'):
+                    data = json.loads(line[len('data:'):].strip())
+                    event = {'event': kind}
+                    if isinstance(data, dict) and 'path' in data:
+                        event.update(data)
+                    yield event
+    return events
@@ -0,0 +1,89 @@
+import os
+import pickle
+from collections import namedtuple
+
+# The question workbook compiled into plain tuples. The compiled schema is kept in memory and in a
+# pickle next to the workbook, both keyed by the workbook's mtime, so the workbook is only parsed
+# again after it changes.
+Question = namedtuple('Question', ['item', 'no', 'category', 'short', 'question', 'choices', 'choice_type', 'chart'])
+Schema = namedtuple('Schema', ['pre', 'post', 'objectives'])  # objectives: week -> learning objectives
+
+SCHEMA_VERSION = 1  # bump when Question/Schema change shape
+QUESTION_COLUMNS = ['No', 'Category', 'ShortQuestion', 'Question', 'Choice', 'ChoiceType', 'Chart']
+CHOICE_TYPES = ['select_slider', 'text_input', 'multiselect', 'selectbox']
+CHARTS = ['bar', 'pie', 'bar-h', 'wordcloud']
+LISTED_CHOICES = ['select_slider', 'multiselect']  # types that need a Choice list in the workbook
+
+_compiled = {}  # path -> (mtime, schema)
+
+
+def load_schema(path='input/survey_questions.xlsx'):
+    mtime = os.stat(path).st_mtime_ns
+    cached = _compiled.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    schema = _read_cache(path, mtime)
+    if schema is None:
+        schema = compile_workbook(path)
+        _write_cache(path, mtime, schema)
+    _compiled[path] = (mtime, schema)
+    return schema
+
+
+def compile_workbook(path):
+    import pandas as pd
+    sheets = pd.read_excel(path, sheet_name=['pre_survey', 'post_survey', 'learning_objectives'])
+    objectives = {}
+    for row in sheets['learning_objectives'].to_dict('records'):
+        if pd.notna(row.get('Week')) and pd.notna(row.get('LearningObjective')):
+            objectives[int(row['Week'])] = tuple(str(row['LearningObjective']).split(';'))
+    return Schema(compile_questions(sheets['pre_survey'], 'pre_survey'),
+                  compile_questions(sheets['post_survey'], 'post_survey'), objectives)
+
+
+def compile_questions(frame, sheet):
+    import pandas as pd
+    missing = [column for column in QUESTION_COLUMNS if column not in frame.columns]
+    if missing:
+        raise ValueError('%s sheet is missing columns: %s' % (sheet, ', '.join(missing)))
+    questions = []
+    for row in frame.to_dict('records'):
+        if pd.isna(row['No']):
+            continue  # blank rows below the questions
+        no = int(row['No'])
+        choices = tuple(str(row['Choice']).split(';')) if pd.notna(row['Choice']) else ()
+        if row['ChoiceType'] not in CHOICE_TYPES:
+            raise ValueError('%s question %d has an unknown ChoiceType: %r' % (sheet, no, row['ChoiceType']))
+        if row['Chart'] not in CHARTS:
+            raise ValueError('%s question %d has an unknown Chart: %r' % (sheet, no, row['Chart']))
+        if row['ChoiceType'] in LISTED_CHOICES and not choices:
+            raise ValueError('%s question %d needs a Choice list' % (sheet, no))
+        questions.append(Question('q' + str(no), no, row['Category'], row['ShortQuestion'], row['Question'], choices,
+                                  row['ChoiceType'], row['Chart']))
+    items = [q.item for q in questions]
+    if len(set(items)) != len(items):
+        raise ValueError('%s sheet has duplicate question numbers' % sheet)
+    return tuple(questions)
+
+
+def cache_path(path):
+    return os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.schema.pickle')
+
+
+def _read_cache(path, mtime):
+    try:
+        with open(cache_path(path), 'rb') as f:
+            version, cached_mtime, schema = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError, AttributeError):
+        return None
+    return schema if version == SCHEMA_VERSION and cached_mtime == mtime else None
+
+
+def _write_cache(path, mtime, schema):
+    target = cache_path(path)
+    try:
+        with open(target + '.tmp', 'wb') as f:
+            pickle.dump((SCHEMA_VERSION, mtime, schema), f)
+        os.replace(target + '.tmp', target)
+    except OSError:
+        pass  # read-only deployments just compile once per process
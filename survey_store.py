@@ -0,0 +1,490 @@
+import argparse
+import copy
+import functools
+import json
+import re
+from collections import Counter
+from urllib.parse import unquote
+import pandas as pd
+import metrics
+from schema import load_schema
+
+# Survey responses live under {pre|post}-survey/week-{week}/group-{group}/{uid}, so a results page
+# downloads only the group-week it shows. The prefixes keep Firebase from turning the numeric
+# week/group keys into arrays.
+WEEK_PREFIX = 'week-'
+GROUP_PREFIX = 'group-'
+FLAT_KEY = re.compile(r'^(?P<uid>.+)_(?P<week>\d+)$')  # legacy {uid}_{week} layout
+INDEX_TREE = 'user-responses'  # {uid}/{pre|post}/week-{week} -> copy of that user's response
+AGGREGATE_TREE = 'aggregates'  # {pre|post}/week-{week}/group-{group}/q{No}/{choice} -> count
+AGGREGATE_CHARTS = ['bar', 'pie', 'bar-h']  # charts drawn from counts rather than raw answers
+TERMS_TREE = 'terms'  # {pre|post}/week-{week}/group-{group}/q{No}/{term} -> count of a free-text word
+TERM_CHARTS = ['wordcloud']
+WORD = re.compile(r"\w[\w']*")  # wordcloud's default tokenizer
+FORBIDDEN_KEY_CHARS = '%.$#[]/'
+TIMEZONE = 'Europe/London'  # timestamps are epoch ms; dates are shown in course time
+START_DAY = '2022-10-03'  # Monday of the first course week, unless the start_day secret says otherwise
+# children queried with order_by_child under each path ($ parts match any key); Firebase refuses
+# those queries unless the rules index the child, see index_rules
+INDEXES = {'activities': ['timestamp'], 'pre-survey/$week/$group': ['timestamp'],
+           'post-survey/$week/$group': ['timestamp']}
+CONFIG_KEYS = ['apiKey', 'authDomain', 'projectId', 'databaseURL', 'storageBucket', 'messagingSenderId', 'appId',
+               'measurementId']
+BATCH_SIZE = 500  # paths per multi-path update
+
+
+def survey_tree(survey_type):
+    return survey_type + '-survey'
+
+
+def week_key(week):
+    return WEEK_PREFIX + str(week)
+
+
+def group_key(group):
+    return GROUP_PREFIX + str(group)
+
+
+def course_start(day=None):
+    # midnight at the start of the first course week, in course time
+    return pd.Timestamp(str(day or START_DAY)).tz_localize(TIMEZONE)
+
+
+def week_of(timestamp, start_day):
+    # course week of an epoch-ms timestamp, counted in course time so a week always starts on Monday
+    # midnight; 0 before the course started
+    if timestamp is None:
+        return None
+    days = (pd.Timestamp(timestamp, unit='ms', tz='UTC').tz_convert(TIMEZONE).tz_localize(None) -
+            start_day.tz_localize(None)).days
+    return max(days // 7 + 1, 0)
+
+
+def weeks_of(timestamps, start_day):
+    # week_of for a list of timestamps in one pass
+    times = pd.to_datetime(pd.Series(timestamps, dtype='float64'), unit='ms', utc=True)
+    days = (times.dt.tz_convert(TIMEZONE).dt.tz_localize(None) - start_day.tz_localize(None)).dt.days
+    return [None if pd.isna(n) else max(int(n) // 7 + 1, 0) for n in days]
+
+
+def response_path(survey_type, week, group=None, uid=None):
+    path = survey_tree(survey_type) + '/' + week_key(week)
+    if group is not None:
+        path += '/' + group_key(group)
+    if uid is not None:
+        path += '/' + uid
+    return path
+
+
+def index_path(uid, survey_type=None, week=None):
+    path = INDEX_TREE + '/' + uid
+    if survey_type is not None:
+        path += '/' + survey_type
+    if week is not None:
+        path += '/' + week_key(week)
+    return path
+
+
+def index_entry(record):
+    return {'timestamp': record.get('timestamp'), 'response': record.get('response')}
+
+
+def index_frame(index, survey_type):
+    # one row per week from a user's index, oldest week first
+    entries = (index or {}).get(survey_type) or {}
+    weeks = sorted((int(wk[len(WEEK_PREFIX):]), entry) for wk, entry in entries.items()
+                   if str(wk).startswith(WEEK_PREFIX) and isinstance(entry, dict))
+    if not weeks:
+        return None
+    frame = response_frame([entry for _, entry in weeks])
+    frame['week'] = [week for week, _ in weeks]
+    return frame
+
+
+def response_frame(records):
+    # one row per record with its metadata, a date and one column per question, built column-wise
+    # in a single pass; multiselect answers stay lists until count_choices explodes them
+    if not records:
+        return None
+    with metrics.span('frame.build', rows=len(records)):
+        frame = pd.DataFrame.from_records(records)
+        responses = frame.pop('response') if 'response' in frame else pd.Series([None] * len(frame))
+        answers = pd.DataFrame.from_records([r if isinstance(r, dict) else {} for r in responses], index=frame.index)
+        frame = frame.join(answers)
+        if 'timestamp' in frame:
+            frame['date'] = pd.to_datetime(frame['timestamp'], unit='ms', utc=True).dt.tz_convert(TIMEZONE) \
+                .dt.tz_localize(None)
+    return frame
+
+
+def count_choices(frame, item, by=()):
+    # answers to one question counted per choice (and per `by` columns); multiselect lists count
+    # once per choice and empty answers aren't counted
+    by = list(by)
+    if frame is None or item not in frame:
+        return pd.Series(dtype='int64', name=item)
+    values = frame[by + [item]].explode(item)
+    values = values[values[item].notna() & (values[item] != '')]
+    return values.groupby(by + [item]).size().rename(item)
+
+
+def aggregate_path(survey_type, week, group):
+    return AGGREGATE_TREE + '/' + survey_type + '/' + week_key(week) + '/' + group_key(group)
+
+
+def encode_key(text):
+    # choices become Firebase keys, which can't contain . $ # [ ] /
+    return ''.join('%%%02X' % ord(c) if c in FORBIDDEN_KEY_CHARS else c for c in str(text))
+
+
+def decode_key(key):
+    return unquote(key)
+
+
+def aggregate_items(questions):
+    return [q.item for q in questions if q.chart in AGGREGATE_CHARTS]
+
+
+def aggregate_delta(response, previous, items):
+    # multi-path update that adds a submission to its group-week counters and takes back the
+    # submission it overwrites; server-side increments keep concurrent submissions consistent
+    delta = Counter()
+    for sign, answers in [(1, response), (-1, previous)]:
+        if answers is None:
+            continue
+        frame = response_frame([{'response': answers}])
+        for item in items:
+            for choice, n in count_choices(frame, item).items():
+                delta[item + '/' + encode_key(choice)] += sign * int(n)
+    update = {path: {'.sv': {'increment': n}} for path, n in delta.items() if n != 0}
+    if previous is None:
+        update['responses'] = {'.sv': {'increment': 1}}
+    return update
+
+
+def submission_update(survey_type, week, group, uid, timestamp, response, previous, items, text_items=()):
+    # every path one submission touches, written together as a single multi-path update at the root
+    record = {'id': uid, 'timestamp': timestamp, 'response': response}
+    update = {response_path(survey_type, week, group, uid): record,
+              index_path(uid, survey_type, week): index_entry(record)}
+    for path, value in aggregate_delta(response, previous, items).items():
+        update[aggregate_path(survey_type, week, group) + '/' + path] = value
+    for path, value in term_delta(response, previous, text_items).items():
+        update[terms_path(survey_type, week, group) + '/' + path] = value
+    return update
+
+
+def terms_path(survey_type, week, group=None):
+    path = TERMS_TREE + '/' + survey_type + '/' + week_key(week)
+    if group is not None:
+        path += '/' + group_key(group)
+    return path
+
+
+def term_items(questions):
+    return [q.item for q in questions if q.chart in TERM_CHARTS]
+
+
+@functools.lru_cache(maxsize=None)
+def stopwords():
+    from wordcloud import STOPWORDS  # wordcloud is only imported once text is counted
+    return frozenset(word.lower() for word in STOPWORDS)
+
+
+def terms(text):
+    # the words a word cloud draws from an answer, as WordCloud.process_text finds them: no 's, no
+    # numbers and no STOPWORDS, lower-cased so counts from different answers add up
+    if not isinstance(text, str):
+        return []
+    words = [word[:-2] if word.lower().endswith("'s") else word for word in WORD.findall(text)]
+    return [word.lower() for word in words if not word.isdigit() and word.lower() not in stopwords()]
+
+
+def term_delta(response, previous, items):
+    # increments that add a submission's words to its group-week term counts and take back the
+    # words of the submission it overwrites
+    delta = Counter()
+    for sign, answers in [(1, response), (-1, previous)]:
+        for item in items:
+            for term in terms((answers or {}).get(item)):
+                delta[item + '/' + encode_key(term)] += sign
+    return {path: {'.sv': {'increment': n}} for path, n in delta.items() if n != 0}
+
+
+def term_counts(tree):
+    # item -> {term: count}, without the words that were all taken back
+    return {item: {decode_key(k): v for k, v in words.items() if v > 0}
+            for item, words in (tree or {}).items() if isinstance(words, dict)}
+
+
+def singular_forms(words):
+    # plural -> singular for every word ending in s (but not ss) whose singular was used too, the
+    # plurals wordcloud counts with their singular
+    words = set(words)
+    return {word: word[:-1] for word in words if word.endswith('s') and not word.endswith('ss') and word[:-1] in words}
+
+
+def merge_plurals(counts):
+    merged = dict(counts)
+    for plural, singular in singular_forms(counts).items():
+        merged[singular] += merged.pop(plural)
+    return merged
+
+
+def aggregate_counts(tree):
+    # item -> counts per choice, without the choices that were all taken back
+    counts = {}
+    for item, choices in (tree or {}).items():
+        if isinstance(choices, dict):
+            series = pd.Series({decode_key(k): v for k, v in choices.items()}, name=item, dtype='int64')
+            counts[item] = series[series > 0]
+    return counts
+
+
+def trend_frame(tree):
+    # every count of a survey's aggregates ({week-W: {group-G: {qN: {choice: n}, responses: n}}}) as one
+    # row per week, group, question and choice, with the group-week's number of responses
+    rows, responses = [], []
+    for wk, groups in (tree or {}).items():
+        if not str(wk).startswith(WEEK_PREFIX) or not isinstance(groups, dict):
+            continue
+        week = int(wk[len(WEEK_PREFIX):])
+        for gk, node in groups.items():
+            if not str(gk).startswith(GROUP_PREFIX) or not isinstance(node, dict):
+                continue
+            group = gk[len(GROUP_PREFIX):]
+            responses.append((week, group, node.get('responses', 0)))
+            rows += [(week, group, item, decode_key(choice), n) for item, choices in node.items()
+                     if isinstance(choices, dict) for choice, n in choices.items()]
+    keys = ['week', 'group', 'item', 'choice']
+    # typed, so a survey without counts yet still gives an (empty) frame with every column
+    frame = pd.DataFrame(rows, columns=keys + ['count']).astype({'week': 'int64', 'count': 'int64'})
+    frame = frame[frame['count'] > 0].groupby(keys, as_index=False)['count'].sum()
+    responses = pd.DataFrame(responses, columns=['week', 'group', 'responses']).astype({'week': 'int64',
+                                                                                        'responses': 'int64'})
+    frame = frame.merge(responses, on=['week', 'group'])
+    frame['share'] = frame['count'] / frame['responses'].where(frame['responses'] > 0)
+    return frame[keys + ['count', 'responses', 'share']]
+
+
+def partition_records(tree):
+    # {week-N: {group-G: {uid: record}}} -> [(week, group, uid, record)]
+    records = []
+    for wk, groups in (tree or {}).items():
+        if not str(wk).startswith(WEEK_PREFIX) or not isinstance(groups, dict):
+            continue
+        for gk, responses in groups.items():
+            if not str(gk).startswith(GROUP_PREFIX) or not isinstance(responses, dict):
+                continue
+            for uid, record in responses.items():
+                records.append((int(wk[len(WEEK_PREFIX):]), gk[len(GROUP_PREFIX):], uid, record))
+    return records
+
+
+def partition_frame(tree):
+    # one row per response of a whole survey tree, with its week, group and uid as columns
+    records = partition_records(tree)
+    if not records:
+        return None
+    frame = response_frame([record for _, _, _, record in records])
+    frame['week'] = [week for week, _, _, _ in records]
+    frame['group'] = [group for _, group, _, _ in records]
+    frame['uid'] = [uid for _, _, uid, _ in records]
+    return frame
+
+
+def partition_responses(partition):
+    # one row per response of a single {uid: record} group-week partition
+    if not partition:
+        return None
+    frame = response_frame(list(partition.values()))
+    frame['uid'] = list(partition)
+    return frame
+
+
+def flat_records(tree):
+    # {uid}_{week} -> (uid, week, record) for responses still stored in the legacy flat layout
+    flat = {}
+    for key, record in (tree or {}).items():
+        match = FLAT_KEY.match(str(key))
+        if match and isinstance(record, dict) and 'response' in record:
+            flat[key] = (match.group('uid'), int(match.group('week')), record)
+    return flat
+
+
+def migrate(db, survey_type, keep_flat=False, dry_run=False):
+    # move flat {uid}_{week} responses into their week/group partitions, verify, then drop the flat copies
+    tree_name = survey_tree(survey_type)
+    tree = db.child(tree_name).get().val() or {}
+    users = db.child('users').get().val() or {}
+    flat = flat_records(tree)
+    existing = {(week, group, uid): record for week, group, uid, record in partition_records(tree)}
+
+    moves, orphans = {}, []
+    for key, (uid, week, record) in flat.items():
+        group = (users.get(uid) or {}).get('group')
+        if group is None:
+            orphans.append(key)
+            continue
+        current = existing.get((week, str(group), uid))
+        # a response submitted after the switch to partitions is newer than its flat copy
+        if current is not None and current.get('timestamp', 0) >= record.get('timestamp', 0):
+            moves[key] = None
+        else:
+            moves[key] = (week_key(week) + '/' + group_key(group) + '/' + uid, record)
+    report = {'survey': tree_name, 'flat': len(flat), 'moved': sum(m is not None for m in moves.values()),
+              'superseded': sum(m is None for m in moves.values()), 'orphans': orphans,
+              'partitioned_before': len(existing)}
+    if dry_run:
+        return report
+
+    writes = {path: record for path, record in filter(None, moves.values())}
+    batch_update(db, tree_name, writes)
+
+    # backfill check: every migrated response must now be readable from its partition
+    migrated = db.child(tree_name).get().val() or {}
+    partitioned = {week_key(w) + '/' + group_key(g) + '/' + u for w, g, u, _ in partition_records(migrated)}
+    missing = [path for path in writes if path not in partitioned]
+    report['partitioned_after'] = len(partitioned)
+    report['missing'] = missing
+    if missing:
+        raise RuntimeError('%d responses missing after migrating %s; flat records kept' % (len(missing), tree_name))
+    if not keep_flat:
+        batch_update(db, tree_name, {key: None for key in moves})
+    return report
+
+
+def backfill_index(db, survey_types=('pre', 'post'), dry_run=False):
+    # rebuild user-responses from the partitioned survey trees and check every response got an entry
+    updates = {}
+    for survey_type in survey_types:
+        tree = db.child(survey_tree(survey_type)).get().val()
+        for week, _, uid, record in partition_records(tree):
+            updates[uid + '/' + survey_type + '/' + week_key(week)] = index_entry(record)
+    report = {'responses': len(updates), 'users': len({path.split('/')[0] for path in updates})}
+    if dry_run:
+        return report
+
+    batch_update(db, INDEX_TREE, updates)
+    index = db.child(INDEX_TREE).get().val() or {}
+    indexed = {uid + '/' + survey_type + '/' + wk for uid, surveys in index.items()
+               for survey_type, weeks in (surveys or {}).items() for wk in (weeks or {})}
+    report['missing'] = [path for path in updates if path not in indexed]
+    if report['missing']:
+        raise RuntimeError('%d responses missing from %s after backfill' % (len(report['missing']), INDEX_TREE))
+    return report
+
+
+def rebuild_aggregates(db, questions, dry_run=False):
+    # recount every group-week from the raw responses and replace the stored aggregates
+    aggregates = {}
+    for survey_type, survey_questions in questions.items():
+        frame = partition_frame(db.child(survey_tree(survey_type)).get().val())
+        if frame is None:
+            continue
+        nodes = aggregates.setdefault(survey_type, {})
+        for (week, group), n in frame.groupby(['week', 'group']).size().items():
+            nodes.setdefault(week_key(week), {})[group_key(group)] = {'responses': int(n)}
+        for item in aggregate_items(survey_questions):
+            for (week, group, choice), n in count_choices(frame, item, by=['week', 'group']).items():
+                node = nodes[week_key(week)][group_key(group)]
+                node.setdefault(item, {})[encode_key(choice)] = int(n)
+    report = {survey_type: sum(len(groups) for groups in aggregates.get(survey_type, {}).values())
+              for survey_type in questions}
+    if not dry_run:
+        for survey_type in questions:
+            db.child(AGGREGATE_TREE).child(survey_type).set(aggregates.get(survey_type))
+    return report
+
+
+def rebuild_terms(db, questions, dry_run=False):
+    # recount the words of every free-text answer and replace the stored term counts
+    counts = {}
+    for survey_type, survey_questions in questions.items():
+        items = term_items(survey_questions)
+        for week, group, _, record in partition_records(db.child(survey_tree(survey_type)).get().val()):
+            node = counts.setdefault(survey_type, {}).setdefault(week_key(week), {}).setdefault(group_key(group), {})
+            for item in items:
+                for term in terms((record.get('response') or {}).get(item)):
+                    key = encode_key(term)
+                    node.setdefault(item, {})[key] = node.get(item, {}).get(key, 0) + 1
+    report = {survey_type: sum(len(groups) for groups in counts.get(survey_type, {}).values())
+              for survey_type in questions}
+    if not dry_run:
+        for survey_type in questions:
+            db.child(TERMS_TREE).child(survey_type).set(counts.get(survey_type))
+    return report
+
+
+def as_dict(value):
+    # pyrebase returns an empty list for a query without results
+    return value if isinstance(value, dict) else {}
+
+
+def query(db, path, order_by, start_at=None, end_at=None, equal_to=None, limit=None):
+    # the children of `path` the database picks by their `order_by` child: one value of it or a range,
+    # then the first `limit` in that order; the child must be in INDEXES
+    selected = db.child(path).order_by_child(order_by)
+    if equal_to is not None:
+        selected = selected.equal_to(equal_to)
+    if start_at is not None:
+        selected = selected.start_at(start_at)
+    if end_at is not None:
+        selected = selected.end_at(end_at)
+    if limit is not None:
+        selected = selected.limit_to_first(limit)
+    return as_dict(selected.get().val())
+
+
+def index_rules(rules=None):
+    # database rules with the ".indexOn" entries of INDEXES merged in, keeping everything else
+    rules = copy.deepcopy(rules) if rules else {'rules': {}}
+    for path, children in INDEXES.items():
+        node = rules.setdefault('rules', {})
+        for part in path.split('/'):
+            node = node.setdefault(part, {})
+        indexed = node.get('.indexOn', [])
+        indexed = [indexed] if isinstance(indexed, str) else list(indexed)  # one child may be given as a string
+        node['.indexOn'] = indexed + [child for child in children if child not in indexed]
+    return rules
+
+
+def batch_update(db, path, updates):
+    items = list(updates.items())
+    for start in range(0, len(items), BATCH_SIZE):
+        db.child(path).update(dict(items[start:start + BATCH_SIZE]))
+
+
+def connect():
+    import pyrebase
+    import streamlit as st
+    firebase = pyrebase.initialize_app({key: st.secrets[key] for key in CONFIG_KEYS})
+    return firebase.database()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Maintain the partitioned survey layout.')
+    parser.add_argument('command', choices=['migrate', 'backfill-index', 'rebuild-aggregates', 'rebuild-terms',
+                                            'index-rules'])
+    parser.add_argument('--survey', choices=['pre', 'post'], action='append')
+    parser.add_argument('--keep-flat', action='store_true', help='keep the flat records after copying them')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be moved')
+    parser.add_argument('--rules', help='index-rules: the current rules file to add the indexes to')
+    args = parser.parse_args()
+    db = connect() if args.command != 'index-rules' else None
+    if args.command == 'migrate':
+        for survey_type in args.survey or ['pre', 'post']:
+            print(migrate(db, survey_type, keep_flat=args.keep_flat, dry_run=args.dry_run))
+    elif args.command == 'backfill-index':
+        print(backfill_index(db, args.survey or ['pre', 'post'], dry_run=args.dry_run))
+    elif args.command in ('rebuild-aggregates', 'rebuild-terms'):
+        schema = load_schema('input/survey_questions.xlsx')
+        questions = {survey_type: getattr(schema, survey_type) for survey_type in args.survey or ['pre', 'post']}
+        rebuild = rebuild_aggregates if args.command == 'rebuild-aggregates' else rebuild_terms
+        print(rebuild(db, questions, dry_run=args.dry_run))
+    elif args.command == 'index-rules':
+        current = None
+        if args.rules:
+            with open(args.rules) as f:
+                current = json.load(f)
+        print(json.dumps(index_rules(current), indent=2))
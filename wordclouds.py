@@ -0,0 +1,70 @@
+import hashlib
+import io
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import metrics
+
+
+class WordCloudCache:
+    # Rendered word clouds as PNG bytes, keyed by a hash of the question, week, group and word counts
+    # they show; the least recently used is dropped beyond `max_entries`. Misses render on a small
+    # worker pool, so the rest of the page goes out while they draw.
+    def __init__(self, background_color, max_entries=64, workers=2):
+        self.background_color = background_color
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> PNG bytes, or None when there were no words to draw
+        self.pending = {}  # key -> Future of a render in progress
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='wordcloud')
+        self.lock = threading.Lock()
+
+    def get(self, scope, frequencies):
+        # future of the PNG for these {word: count}; already resolved on a hit
+        key = cache_key(scope, frequencies)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                future = Future()
+                future.set_result(self.entries[key])
+                return future
+            if key not in self.pending:
+                self.pending[key] = self.pool.submit(metrics.bind(self._render), key, dict(frequencies))
+            return self.pending[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def _render(self, key, frequencies):
+        # a failed render isn't kept: its future raises, and the next view of the page tries again
+        try:
+            try:
+                with metrics.span('wordcloud.render'):
+                    png = render_png(frequencies, self.background_color)
+            except ValueError:  # no words to draw
+                png = None
+            with self.lock:
+                self.entries[key] = png
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            return png
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+
+def cache_key(scope, frequencies):
+    return hashlib.sha1(json.dumps([list(scope), sorted(frequencies.items())], default=str).encode('utf-8')).hexdigest()
+
+
+def render_png(frequencies, background_color):
+    # drawn from counted words (see survey_store.terms) straight to an image, without a matplotlib
+    # figure to leak; wordcloud (and the matplotlib it pulls in) is only imported once a word cloud
+    # is actually drawn
+    from wordcloud import WordCloud
+    cloud = WordCloud(background_color=background_color, colormap='Set3', random_state=1, mode='RGBA',
+                      scale=3).generate_from_frequencies(frequencies)
+    buffer = io.BytesIO()
+    cloud.to_image().save(buffer, format='PNG')
+    return buffer.getvalue()